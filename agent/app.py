@@ -1,11 +1,27 @@
-from fastapi import FastAPI
+import json
+import time
+import sqlite3
+import itertools
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import uvicorn
-from dialogue_manager import get_initial_state, create_workflow
+from dialogue_manager import get_initial_state, create_workflow, llm_schedulers, model_router, chain_registry
+from chain_registry import warm_up
+from singleflight import single_flight_stats
+from tools import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, decode_cursor, iter_product_pages, log_query, lookup_category_facets
 from langchain_core.messages import HumanMessage, AIMessage
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Check the DB, map the snapshot and prime caches before accepting traffic
+    warm_up(chain_registry)
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
 # Create workflow once at startup
 workflow = create_workflow()
@@ -25,17 +41,24 @@ class Message(BaseModel):
 
 # In-memory storage for conversations
 conversations = {}
+conversation_ids = itertools.count(1)
+
+# The chat handlers are plain `def` on purpose: workflow.invoke blocks, so
+# FastAPI runs them in its threadpool and concurrent chats' turns overlap
+# (which is also what lets identical lookups and LLM calls coalesce).
 
 @app.get("/chat/start")
-async def start_chat():
+def start_chat():
     """Start a new chat with a greeting"""
-    conversation_id = str(len(conversations) + 1)
+    conversation_id = str(next(conversation_ids))
     
     # Initialize state
     state = get_initial_state()
     
     # Run the workflow to get greeting
+    start = time.perf_counter()
     result = workflow.invoke(state)
+    print(f"\n[timing] start_chat turn took {time.perf_counter() - start:.3f}s")
     conversations[conversation_id] = result
     
     return {
@@ -44,7 +67,7 @@ async def start_chat():
     }
 
 @app.post("/chat")
-async def chat_endpoint(message: Message):
+def chat_endpoint(message: Message):
     if not message.conversation_id or message.conversation_id not in conversations:
         return {"error": "Invalid conversation ID. Please start a new chat."}
     
@@ -57,7 +80,9 @@ async def chat_endpoint(message: Message):
     )
     
     # Process the message through workflow
+    start = time.perf_counter()
     result = workflow.invoke(current_state)
+    print(f"\n[timing] chat turn took {time.perf_counter() - start:.3f}s")
     
     # Store the updated state
     conversations[message.conversation_id] = result
@@ -70,5 +95,62 @@ async def chat_endpoint(message: Message):
         "conversation_id": message.conversation_id
     }
 
+@app.get("/products/search")
+def search_products(
+    q: str = Query(..., min_length=1),
+    page_size: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+):
+    """Stream matching products as NDJSON: one facets line, then one line per page"""
+    if cursor:
+        try:
+            decode_cursor(cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    if not cursor:
+        log_query(q)
+
+    # Run the facet query and the first page before the 200 goes out, so a
+    # database failure is an HTTP error rather than a truncated body
+    try:
+        facets = lookup_category_facets(q)
+        pages = iter_product_pages(q, page_size, cursor)
+        first_page = next(pages, None)
+    except (ValueError, sqlite3.Error) as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+    def page_line(products, next_cursor):
+        return json.dumps({
+            "type": "page",
+            "products": [p.model_dump() for p in products],
+            "next_cursor": next_cursor,
+        }) + "\n"
+
+    def stream():
+        yield json.dumps({"type": "facets", "query": q, **facets}) + "\n"
+
+        if first_page is not None:
+            yield page_line(*first_page)
+        for products, next_cursor in pages:
+            yield page_line(products, next_cursor)
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.get("/metrics/single-flight")
+async def single_flight_metrics():
+    """Report how many lookups and LLM calls were coalesced into in-flight ones"""
+    return single_flight_stats()
+
+@app.get("/metrics/llm")
+async def llm_metrics():
+    """Report LLM queue depth per priority, in-flight calls and retries, per model tier"""
+    return {tier: scheduler.metrics() for tier, scheduler in llm_schedulers.items()}
+
+@app.get("/metrics/models")
+async def model_metrics():
+    """Report per-node latency and cost for each model tier"""
+    return model_router.metrics()
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=5000)
\ No newline at end of file
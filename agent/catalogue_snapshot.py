@@ -0,0 +1,286 @@
+import os
+import mmap
+import time
+import array
+import struct
+import sqlite3
+import argparse
+import threading
+from bisect import bisect_left
+from typing import List, Optional
+
+from schema import ProductDetails
+
+# Columnar, read-only export of DIM_ITEMS that every worker process can mmap.
+# The OS shares the mapped pages between processes, so N uvicorn workers pay
+# for one copy of the catalogue instead of N private caches.
+#
+# Layout (native byte order, every section 8-byte aligned):
+#
+#   header    MAGIC, format version, row count, section count
+#   sections  (offset, length) pairs for the sections below
+#   sku_ids            int64[rows]   sorted ascending, row i is SKU sku_ids[i]
+#   name_offsets       uint32[rows+1] into name_blob
+#   name_blob          utf-8 product names
+#   l4 / l5 tables     for each category level:
+#       codes              uint32[rows]   category code of each row, NULL_CODE for NULL
+#       string_offsets     uint32[cats+1] into string_blob
+#       string_blob        utf-8 category names, sorted, so codes are ordinal
+#       postings           uint32[rows]   row ids grouped by category code
+#       posting_offsets    uint32[cats+1] into postings
+
+MAGIC = b"WBCATSNP"
+FORMAT_VERSION = 2
+HEADER = struct.Struct("=8sIIQ")
+SECTION = struct.Struct("=QQ")
+
+SKU_IDS, NAME_OFFSETS, NAME_BLOB = 0, 1, 2
+L4_BASE, L5_BASE = 3, 8
+CODES, STRING_OFFSETS, STRING_BLOB, POSTINGS, POSTING_OFFSETS = range(5)
+SECTION_COUNT = 13
+
+# NULL categories get their own code outside the string table, so they never
+# match a lookup, just as `= ?` never matches NULL in SQLite
+NULL_CODE = 0xFFFFFFFF
+
+SNAPSHOT_PATH = os.getenv("CATALOGUE_SNAPSHOT_PATH")
+SNAPSHOT_CHECK_INTERVAL = 5.0
+
+
+def _align(n: int) -> int:
+    return (n + 7) & ~7
+
+
+def _string_table(values: List[str]):
+    """ Pack strings into an offsets array and a single utf-8 blob """
+    offsets = array.array("I", [0])
+    blob = bytearray()
+    for value in values:
+        blob += value.encode("utf-8")
+        offsets.append(len(blob))
+    return offsets, bytes(blob)
+
+
+def _category_sections(categories: List[Optional[str]]):
+    """ Dictionary-encode one category column and build its posting lists """
+    names = sorted(set(c for c in categories if c is not None))
+    code_of = {name: code for code, name in enumerate(names)}
+
+    codes = array.array("I", (NULL_CODE if c is None else code_of[c] for c in categories))
+    string_offsets, string_blob = _string_table(names)
+
+    buckets = [[] for _ in names]
+    for row_id, code in enumerate(codes):
+        if code != NULL_CODE:
+            buckets[code].append(row_id)
+
+    postings = array.array("I")
+    posting_offsets = array.array("I", [0])
+    for bucket in buckets:
+        postings.extend(bucket)
+        posting_offsets.append(len(postings))
+
+    return [codes, string_offsets, string_blob, postings, posting_offsets]
+
+
+def build_snapshot(db_path: str, out_path: str) -> int:
+    """ Export DIM_ITEMS into a snapshot file and atomically swap it into place """
+    start = time.perf_counter()
+
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT skuId, skuName, catLevel4Name, catLevel5Name FROM DIM_ITEMS"
+        ).fetchall()
+    finally:
+        conn.close()
+
+    # The SKU column is binary searched as int64. Refuse to build rather than
+    # silently serve a different product set from the SQLite fallback.
+    parsed = []
+    invalid = []
+    for sku, name, l4, l5 in rows:
+        if type(sku) is not int:
+            invalid.append(sku)
+            continue
+        parsed.append((sku, name or "", l4, l5))
+    if invalid:
+        examples = ", ".join(repr(sku) for sku in invalid[:5])
+        raise ValueError(f"DIM_ITEMS has {len(invalid)} non-integer skuId values (e.g. {examples}); cannot build a snapshot")
+    parsed.sort(key=lambda row: row[0])
+
+    sku_ids = array.array("q", (row[0] for row in parsed))
+    name_offsets, name_blob = _string_table([row[1] for row in parsed])
+
+    sections = [sku_ids, name_offsets, name_blob]
+    sections += _category_sections([row[2] for row in parsed])
+    sections += _category_sections([row[3] for row in parsed])
+
+    payloads = [s.tobytes() if isinstance(s, array.array) else s for s in sections]
+
+    offset = _align(HEADER.size + SECTION.size * SECTION_COUNT)
+    table = []
+    for payload in payloads:
+        table.append((offset, len(payload)))
+        offset = _align(offset + len(payload))
+
+    # Write next to the target and rename over it: readers that already mapped
+    # the old file keep their pages, new readers see the complete new file.
+    tmp_path = f"{out_path}.tmp-{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(parsed), SECTION_COUNT))
+        for section_offset, length in table:
+            f.write(SECTION.pack(section_offset, length))
+        for (section_offset, _), payload in zip(table, payloads):
+            f.seek(section_offset)
+            f.write(payload)
+        f.truncate(_align(f.tell()))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, out_path)
+
+    elapsed = time.perf_counter() - start
+    print(f"Wrote catalogue snapshot {out_path}: {len(parsed)} rows in {elapsed:.2f}s")
+    return len(parsed)
+
+
+class _StringTable:
+    """ Read-only view over a packed, sorted string table """
+
+    def __init__(self, offsets: memoryview, blob: memoryview):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+    def index(self, value: str) -> Optional[int]:
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid] < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self[lo] == value:
+            return lo
+        return None
+
+
+class _CategoryColumn:
+    def __init__(self, sections: List[memoryview]):
+        self.codes = sections[CODES].cast("I")
+        self.names = _StringTable(sections[STRING_OFFSETS].cast("I"), sections[STRING_BLOB])
+        self.postings = sections[POSTINGS].cast("I")
+        self.posting_offsets = sections[POSTING_OFFSETS].cast("I")
+
+    def value(self, row_id: int) -> Optional[str]:
+        code = self.codes[row_id]
+        if code == NULL_CODE:
+            return None
+        return self.names[code]
+
+    def rows(self, name: str) -> memoryview:
+        code = self.names.index(name)
+        if code is None:
+            return self.postings[0:0]
+        return self.postings[self.posting_offsets[code]:self.posting_offsets[code + 1]]
+
+
+class CatalogueSnapshot:
+    """ Memory-mapped catalogue snapshot answering SKU and category lookups """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.identity = (stat.st_ino, stat.st_mtime_ns)
+
+        magic, version, self.row_count, section_count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != FORMAT_VERSION or section_count != SECTION_COUNT:
+            raise ValueError(f"{path} is not a version {FORMAT_VERSION} catalogue snapshot")
+
+        view = memoryview(self._mmap)
+        sections = []
+        for i in range(section_count):
+            offset, length = SECTION.unpack_from(self._mmap, HEADER.size + i * SECTION.size)
+            sections.append(view[offset:offset + length])
+
+        self.sku_ids = sections[SKU_IDS].cast("q")
+        self.names = _StringTable(sections[NAME_OFFSETS].cast("I"), sections[NAME_BLOB])
+        self.buyer_categories = _CategoryColumn(sections[L4_BASE:L4_BASE + 5])
+        self.product_categories = _CategoryColumn(sections[L5_BASE:L5_BASE + 5])
+
+    def __len__(self) -> int:
+        return self.row_count
+
+    def product(self, row_id: int) -> ProductDetails:
+        return ProductDetails(
+            sku=self.sku_ids[row_id],
+            product_name=self.names[row_id],
+            buyer_category=self.buyer_categories.value(row_id),
+            product_category=self.product_categories.value(row_id)
+        )
+
+    def get_sku(self, sku) -> Optional[ProductDetails]:
+        try:
+            sku = int(sku)
+        except (TypeError, ValueError):
+            return None
+        row_id = bisect_left(self.sku_ids, sku)
+        if row_id < self.row_count and self.sku_ids[row_id] == sku:
+            return self.product(row_id)
+        return None
+
+    def by_buyer_category(self, name: str, limit: Optional[int] = None) -> List[ProductDetails]:
+        return [self.product(row_id) for row_id in self.buyer_categories.rows(name)[:limit]]
+
+    def by_product_category(self, name: str, limit: Optional[int] = None) -> List[ProductDetails]:
+        return [self.product(row_id) for row_id in self.product_categories.rows(name)[:limit]]
+
+
+_snapshot: Optional[CatalogueSnapshot] = None
+_snapshot_checked_at = 0.0
+_snapshot_lock = threading.Lock()
+
+
+def get_catalogue_snapshot(path: Optional[str] = SNAPSHOT_PATH) -> Optional[CatalogueSnapshot]:
+    """ Return the mapped snapshot, remapping it if the file has been swapped """
+    global _snapshot, _snapshot_checked_at
+
+    if not path:
+        return None
+
+    now = time.monotonic()
+    if _snapshot is not None and _snapshot.path == path and now - _snapshot_checked_at < SNAPSHOT_CHECK_INTERVAL:
+        return _snapshot
+
+    with _snapshot_lock:
+        _snapshot_checked_at = now
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            _snapshot = None
+            return None
+
+        if _snapshot is None or _snapshot.path != path or _snapshot.identity != (stat.st_ino, stat.st_mtime_ns):
+            # Callers still holding the old snapshot keep a valid mapping until they drop it
+            print(f"Mapping catalogue snapshot {path}")
+            _snapshot = CatalogueSnapshot(path)
+
+        return _snapshot
+
+
+if __name__ == "__main__":
+    from tools import DB_PATH
+
+    parser = argparse.ArgumentParser(description="Export DIM_ITEMS into a memory-mapped catalogue snapshot")
+    parser.add_argument("--db", default=DB_PATH, help="SQLite catalogue database")
+    parser.add_argument("--out", default=SNAPSHOT_PATH, required=SNAPSHOT_PATH is None, help="Snapshot file to write")
+    args = parser.parse_args()
+
+    build_snapshot(args.db, args.out)
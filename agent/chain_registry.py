@@ -0,0 +1,191 @@
+import os
+import time
+import sqlite3
+from collections import Counter
+from typing import Dict, List, Optional
+
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.output_parsers import PydanticOutputParser
+from langchain_core.runnables import Runnable
+
+from schema import ProductIdentification
+from model_router import ModelRouter, ParsedChain
+from catalogue_snapshot import get_catalogue_snapshot
+from tools import (
+    SKULookupTool,
+    ProductLookupTool,
+    CategoryLookupTool,
+    DB_PATH,
+    QUERY_LOG_PATH,
+    catalogue_version,
+    close_connection,
+    lookup_category_facets,
+)
+
+# Prompts, parsers, chains and tools are built once at startup instead of on
+# every node invocation. Nodes look them up here by name.
+
+WARMUP_TOP_N = int(os.getenv("WARMUP_TOP_N", "50"))
+
+GREET_PROMPT = ChatPromptTemplate.from_messages([
+    """You are an audience building assistant for Nectar 360.
+    Greet the user warmly and ask which product and corresponding SKU they'd like to build audiences for.
+
+    Don't sound cheesy or corporate.
+    """]
+)
+
+IDENTIFY_PRODUCT_PROMPT = ChatPromptTemplate.from_messages([
+    """Extract the product that the user wants to build audiences for.
+
+    User Message: {user_message}
+
+    {format_instructions}
+    """
+])
+
+CLARIFY_PRODUCT_PROMPT = ChatPromptTemplate.from_template(
+    """I'm not sure which product you'd like to build audiences for.
+    Could you please specify the product name?"""
+)
+
+CONFIRM_PRODUCT_PROMPT = ChatPromptTemplate.from_template(
+    """
+    You are an audience building assistant for retail media.
+
+    The user wants to build audiences for the product: {product_name}
+
+    Respond with a brief, friendly confirmation that you'll help them build audiences for this product.
+    """
+)
+
+PRODUCT_SUMMARY_PROMPT = ChatPromptTemplate.from_template(
+    """You are an audience building assistant for retail media.
+
+    You just received details for the Product Name {product_name}.
+    You have also just run a search to return similar product variants, with results grouped by Buyer Category and Product Categories.
+
+    - Product Name: {product_name}
+    - Product Details: {product_search_results}
+
+    Respond warmly to the user confirming the Product Name.
+    Summarise the product variants that have been found, specifying the unique Buyer Categories and Product Categories.
+
+    Do not say 'Hi' or 'Hello' or anything like that. You have already spoken with the user.
+
+    YOU MUST RESPOND as the assistant.
+    """
+)
+
+PRODUCT_NOT_FOUND_PROMPT = ChatPromptTemplate.from_template(
+    """You are an audience building assistant for retail media.
+
+    The user asked about Product Name {product_name}, but it could not be found in our database.
+
+    Politely inform them that you couldn't find this Product and ask if they'd like to try a different product.
+
+    Respond as the assistant.
+    """
+)
+
+PRODUCT_TABLE_PROMPT = ChatPromptTemplate.from_template("""
+You are a data formatter that creates clean, readable summaries from product data.
+
+Here are the search results for products:
+
+Buyer Categories: {buyer_categories}
+Product Categories: {product_categories}
+Total Results: {total_results}
+
+Sample products:
+{sample_products}
+
+1. First, provide a brief summary of the search results.
+2. Then, create a well-formatted markdown table showing the most relevant products.
+3. Include columns for: Buyer Category, Product Category, SKU Number, Product Name.
+4. Limit to showing at most 10 products total.
+""")
+
+
+class ChainRegistry:
+    """ Chains and tools shared by every node and every conversation """
+
+    def __init__(self, router: ModelRouter):
+        identification_parser = PydanticOutputParser(pydantic_object=ProductIdentification)
+        # The format instructions never change, so render them into the prompt once
+        identify_prompt = IDENTIFY_PRODUCT_PROMPT.partial(
+            format_instructions=identification_parser.get_format_instructions()
+        )
+
+        self.identify_product: ParsedChain = router.parsed_chain(
+            "identify_product", identify_prompt, identification_parser
+        )
+        self.chains: Dict[str, Runnable] = {
+            "greet": GREET_PROMPT | router.for_node("greet"),
+            "clarify_product": CLARIFY_PRODUCT_PROMPT | router.for_node("clarify_product"),
+            "confirm_product": CONFIRM_PRODUCT_PROMPT | router.for_node("confirm_product"),
+            "lookup_product_details": PRODUCT_SUMMARY_PROMPT | router.for_node("lookup_product_details"),
+            "product_not_found": PRODUCT_NOT_FOUND_PROMPT | router.for_node("product_not_found"),
+            "format_product_table": PRODUCT_TABLE_PROMPT | router.for_node("format_product_table"),
+        }
+
+        self.sku_lookup = SKULookupTool()
+        self.product_lookup = ProductLookupTool()
+        self.category_lookup = CategoryLookupTool()
+
+    def chain(self, name: str) -> Runnable:
+        return self.chains[name]
+
+
+def top_queries(path: Optional[str] = QUERY_LOG_PATH, n: int = WARMUP_TOP_N) -> List[str]:
+    """ The n most frequent product searches in the query log and its rotated copy """
+    if not path:
+        return []
+    counts = Counter()
+    for log_path in (f"{path}.1", path):
+        if os.path.exists(log_path):
+            with open(log_path, encoding="utf-8") as f:
+                counts.update(line.strip() for line in f if line.strip())
+    return [query for query, _ in counts.most_common(n)]
+
+
+def warm_up(registry: ChainRegistry, query_log_path: Optional[str] = QUERY_LOG_PATH, top_n: int = WARMUP_TOP_N) -> Dict[str, float]:
+    """ Check the DB, map the snapshot and prime the search caches before serving traffic """
+    timings = {}
+
+    # SQLite connections are per thread and requests run on other threads, so
+    # this only checks the catalogue opens; they connect on their first query
+    start = time.perf_counter()
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        version = catalogue_version(conn)
+    finally:
+        conn.close()
+    timings["database"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    snapshot = get_catalogue_snapshot()
+    timings["snapshot"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    queries = top_queries(query_log_path, top_n)
+    primed = 0
+    for query in queries:
+        try:
+            # Same arguments as the search_products and expand_categories nodes
+            registry.product_lookup.invoke({"name": query, "include_facets": False})
+            lookup_category_facets(query)
+            primed += 1
+        except ValueError as e:
+            print(f"Warm-up skipped {query!r}: {e}")
+    # The results live in the shared caches; this thread's connection is done
+    close_connection()
+    timings["search_cache"] = time.perf_counter() - start
+
+    print(
+        f"Warm-up done: catalogue version {version}, "
+        f"snapshot {'mapped' if snapshot is not None else 'not configured'}, "
+        f"{primed}/{len(queries)} top queries primed; "
+        + ", ".join(f"{step} {seconds:.3f}s" for step, seconds in timings.items())
+    )
+    return timings
@@ -0,0 +1,97 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# dialogue_manager builds its Azure clients at import; tests replace the
+# models with stubs, so placeholder settings are enough
+os.environ.setdefault("END_POINT", "http://localhost:9")
+os.environ.setdefault("AZURE_OAI_KEY", "test")
+os.environ.setdefault("API_VERSION_GPT", "2024-06-01")
+
+
+@pytest.fixture
+def catalogue_db(tmp_path):
+    """ A small DIM_ITEMS catalogue: 25 KitKat variants plus unrelated products """
+    db_path = tmp_path / "db.db"
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE DIM_ITEMS (skuId, skuName, catLevel4Name, catLevel5Name)")
+    rows = [(sku, f"KitKat {sku}g", "Single Confectionery", "Kit Kat") for sku in range(1, 21)]
+    rows += [(sku, f"Chunky KitKat {sku}g", "Single Confectionery", "Prem Choc") for sku in range(21, 26)]
+    rows += [(100, "KitKat", "Adult Lunchbox Bisc", None), (200, "Mini Eggs", "Easter Non Shell", "Standard Mini Eggs")]
+    conn.executemany("INSERT INTO DIM_ITEMS VALUES (?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+    return str(db_path)
+
+
+class FakeChatServer:
+    """ A /chat/completions endpoint that plays back scripted (status, headers) replies, then 200s """
+
+    def __init__(self):
+        self.script = []
+        self.arrivals = []
+        self.lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with server.lock:
+                    server.arrivals.append(time.monotonic())
+                    status, headers = server.script.pop(0) if server.script else (200, {})
+
+                if status == 200:
+                    body = {
+                        "id": "chatcmpl-test",
+                        "object": "chat.completion",
+                        "created": 0,
+                        "model": "gpt-4o",
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
+                        "usage": {"prompt_tokens": 5, "completion_tokens": 1, "total_tokens": 6},
+                    }
+                else:
+                    body = {"error": {"code": str(status), "message": "scripted failure"}}
+
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def chat_model(self):
+        """ An Azure chat model pointed at this server, configured like create_chat_model """
+        from langchain_openai import AzureChatOpenAI
+
+        return AzureChatOpenAI(
+            azure_deployment="gpt-4o",
+            openai_api_version="2024-06-01",
+            azure_endpoint=self.url,
+            api_key="test",
+            temperature=0,
+            max_retries=0
+        )
+
+
+@pytest.fixture
+def fake_chat_server():
+    server = FakeChatServer()
+    thread = threading.Thread(target=server.httpd.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.httpd.shutdown()
+    server.httpd.server_close()
@@ -1,16 +1,21 @@
 import os
+import time
 import logging
+from functools import wraps
 from dotenv import load_dotenv
 
-from langgraph.graph import StateGraph, END
-from langchain_core.prompts import ChatPromptTemplate
+from langgraph.graph import StateGraph, START, END
 from langchain_core.messages import HumanMessage, AIMessage
-from langchain_core.output_parsers import PydanticOutputParser
+from langchain_core.runnables import RunnableConfig
 from langchain.output_parsers import StructuredOutputParser
 from langchain_openai import AzureChatOpenAI
 
-from schema import AudienceBuilderState, ProductIdentification, ProductSearchResults
-from tools import SKULookupTool, ProductLookupTool
+from schema import AudienceBuilderState, ProductSearchResults
+from tools import lookup_category_facets, log_query
+from chain_registry import ChainRegistry
+from singleflight import create_single_flight
+from llm_scheduler import LLMScheduler, BACKGROUND
+from model_router import ModelRouter, STRONG, FAST, TIER_DEPLOYMENTS, parse_node_tiers
 
 from pprint import pprint
 
@@ -32,31 +37,68 @@ load_dotenv()
 
 AZURE_OAI_KEY = os.getenv("AZURE_OAI_KEY")
 END_POINT = os.getenv("END_POINT")
-DEPLOYMENT_NAME = "gpt-4o"
 API_VERSION_GPT = os.getenv("API_VERSION_GPT")
 
-llm = AzureChatOpenAI(
-    azure_deployment=DEPLOYMENT_NAME,
-    openai_api_version=API_VERSION_GPT,
-    azure_endpoint=END_POINT,
-    api_key=AZURE_OAI_KEY,
-    temperature=0,
-    streaming=True
+def create_chat_model(deployment_name: str) -> AzureChatOpenAI:
+    return AzureChatOpenAI(
+        azure_deployment=deployment_name,
+        openai_api_version=API_VERSION_GPT,
+        azure_endpoint=END_POINT,
+        api_key=AZURE_OAI_KEY,
+        temperature=0,
+        streaming=True,
+        # Token usage on streamed replies, for per-tier cost reporting
+        stream_usage=True,
+        # Retries are owned by the scheduler so they respect the shared budget
+        max_retries=0
+    )
+
+# Extraction and the search summary/table need the strong model; the
+# conversational filler around them runs on the fast deployment.
+# NODE_MODEL_TIERS="greet=strong,..." overrides individual nodes. The
+# strong-tier retry on unparseable output only applies to identify_product
+# when it is overridden onto the fast tier.
+NODE_TIERS = {
+    "greet": FAST,
+    "identify_product": STRONG,
+    "clarify_product": FAST,
+    "confirm_product": FAST,
+    "lookup_product_details": STRONG,
+    "product_not_found": FAST,
+    "format_product_table": STRONG,
+    **parse_node_tiers(os.getenv("NODE_MODEL_TIERS")),
+}
+
+# Conversational replies are admitted ahead of the longer search summaries and
+# tables. Those still finish the same /chat turn, so the scheduler ages them to
+# interactive after LLMScheduler.aging_seconds rather than letting them starve.
+NODE_PRIORITIES = {
+    "lookup_product_details": BACKGROUND,
+    "format_product_table": BACKGROUND,
+}
+
+# Each deployment has its own Azure quota, so each tier gets its own scheduler,
+# e.g. LLM_TOKENS_PER_MINUTE_FAST overrides LLM_TOKENS_PER_MINUTE for the fast tier
+llm_schedulers = {tier: LLMScheduler.from_env(tier) for tier in TIER_DEPLOYMENTS}
+
+model_router = ModelRouter(
+    models={tier: create_chat_model(deployment) for tier, deployment in TIER_DEPLOYMENTS.items()},
+    node_tiers=NODE_TIERS,
+    node_priorities=NODE_PRIORITIES,
+    schedulers=llm_schedulers
 )
 
+# Prompts, parsers, chains and tools are compiled once, not per node call
+chain_registry = ChainRegistry(model_router)
+
+# Chats asking about the same product at the same time share one summary call.
+# temperature=0 makes the replies interchangeable.
+product_summary_flight = create_single_flight("product_summary")
+
 def greet(state: AudienceBuilderState) -> AudienceBuilderState:
     pprint(f"\n\nGreeting user from state: {state}")
     
-    prompt = ChatPromptTemplate.from_messages([
-        """You are an audience building assistant for Nectar 360.
-        Greet the user warmly and ask which product and corresponding SKU they'd like to build audiences for.
-
-        Don't sound cheesy or corporate.
-        """]
-    )
-
-    chain = prompt | llm
-    response = chain.invoke({})
+    response = chain_registry.chain("greet").invoke({})
 
     return {
         **state,
@@ -81,32 +123,13 @@ def identify_product(state: AudienceBuilderState) -> AudienceBuilderState:
     if not last_user_message:
         return {**state, "current_node": END}
     
-    parser = PydanticOutputParser(pydantic_object=ProductIdentification)
-    
-    prompt = ChatPromptTemplate.from_messages([
-        """Extract the product that the user wants to build audiences for.
-        
-        User Message: {user_message}
-
-        {format_instructions}
-        """
-    ])
-
-    chain = prompt | llm | parser
-    result = chain.invoke({
-        "user_message": last_user_message,
-        "format_instructions": parser.get_format_instructions()
+    result = chain_registry.identify_product.invoke({
+        "user_message": last_user_message
     })
 
     if not result.product_name:
         # Could not parse a SKU: ask for clarification again
-        clarification_prompt = ChatPromptTemplate.from_template(
-            """I'm not sure which product you'd like to build audiences for. 
-            Could you please specify the product name?"""
-        )
-        
-        clarification_chain = clarification_prompt | llm
-        clarification_response = clarification_chain.invoke({})
+        clarification_response = chain_registry.chain("clarify_product").invoke({})
 
         return {
             **state,
@@ -117,103 +140,122 @@ def identify_product(state: AudienceBuilderState) -> AudienceBuilderState:
         }
 
     else:
-        # Found a SKU -> confirm and then move to lookup step
-        confirmation_prompt = ChatPromptTemplate.from_template(
-            """
-            You are an audience building assistant for retail media.
-
-            The user wants to build audiences for the product: {product_name}
-
-            Respond with a brief, friendly confirmation that you'll help them build audiences for this product.
-            """
-        ) 
-
-        confirmation_chain = confirmation_prompt | llm
-        confirmation_response = confirmation_chain.invoke({
-            "product_name": result.product_name,
-        })
-        
+        # Found a product -> confirm it while the lookup branch searches
+        # and summarises, then join in present_product_details
         return {
             **state,
             "product_name": result.product_name,
-            "conversation_history": state["conversation_history"] + [
-                AIMessage(content=confirmation_response.content)
-            ],
             "current_node": "lookup_product_details"
         }
 
-def lookup_product_details(state: AudienceBuilderState) -> AudienceBuilderState:
+# After identify_product the turn splits into two concurrent branches that
+# depend only on product_name:
+#   confirm_product          the confirmation reply
+#   lookup_product_details   a subgraph: search_products and expand_categories
+#                            in parallel, then summarise_products
+# Each branch returns just the keys it owns so LangGraph can merge them, and
+# present_product_details joins them in conversation order.
+
+def confirm_product(state: AudienceBuilderState) -> AudienceBuilderState:
+    confirmation_response = chain_registry.chain("confirm_product").invoke({
+        "product_name": state.get("product_name"),
+    })
+
+    return {
+        "conversation_history": state["conversation_history"] + [
+            AIMessage(content=confirmation_response.content)
+        ]
+    }
 
-    print(f"\n\nLooking up product details for Product Name: {state.get('product_name')}")
+def search_products(state: AudienceBuilderState) -> AudienceBuilderState:
+    print(f"\n\nSearching products for Product Name: {state.get('product_name')}")
 
-    product_name = state.get("product_name")
-    product_lookup_tool = ProductLookupTool()
+    log_query(state.get("product_name"))
 
     try:
-        product_search_results = product_lookup_tool.invoke(product_name)
+        # Category facets are counted by expand_categories in parallel
+        product_search_results = chain_registry.product_lookup.invoke({
+            "name": state.get("product_name"),
+            "include_facets": False
+        })
+    except Exception as e:
+        print("\nException in search_products:", repr(e))
+        product_search_results = None
 
-        # Summarize the details to the user
-        response_prompt = ChatPromptTemplate.from_template(
-            """You are an audience building assistant for retail media.
-            
-            You just received details for the Product Name {product_name}. 
-            You have also just run a search to return similar product variants, with results grouped by Buyer Category and Product Categories.
-            
-            - Product Name: {product_name}
-            - Product Details: {product_search_results}
+    return {"product_search_results": product_search_results}
 
-            Respond warmly to the user confirming the Product Name.
-            Summarise the product variants that have been found, specifying the unique Buyer Categories and Product Categories.
+def expand_categories(state: AudienceBuilderState) -> AudienceBuilderState:
+    print(f"\n\nExpanding categories for Product Name: {state.get('product_name')}")
 
-            Do not say 'Hi' or 'Hello' or anything like that. You have already spoken with the user.
+    try:
+        category_facets = lookup_category_facets(state.get("product_name"))
+    except Exception as e:
+        print("\nException in expand_categories:", repr(e))
+        category_facets = None
 
-            YOU MUST RESPOND as the assistant.
-            """
-        )
+    return {"category_facets": category_facets}
 
-        response_chain = response_prompt | llm
-        response = response_chain.invoke({
-            "product_name": product_name,
-            "product_search_results": product_search_results
-        })
+def summarise_products(state: AudienceBuilderState) -> AudienceBuilderState:
+
+    print(f"\n\nSummarising product details for Product Name: {state.get('product_name')}")
+
+    product_name = state.get("product_name")
 
-        print(f"\n\nResponse: {response.content}")
+    try:
+        product_search_results = state.get("product_search_results")
+        if product_search_results is None:
+            raise ValueError(f"Product with name {product_name} not found")
+
+        # Merge the database-wide category counts into the first page of results
+        category_facets = state.get("category_facets")
+        if category_facets:
+            product_search_results = product_search_results.model_copy(update={
+                "total_results": category_facets["total_results"],
+                "unique_buyer_categories": list(category_facets["buyer_category_counts"]),
+                "unique_product_categories": list(category_facets["product_category_counts"]),
+                "buyer_category_counts": category_facets["buyer_category_counts"],
+                "product_category_counts": category_facets["product_category_counts"],
+            })
+
+        # Summarize the details to the user
+        response_chain = chain_registry.chain("lookup_product_details")
+        response_content = product_summary_flight.do(
+            (product_name, product_search_results.model_dump_json()),
+            lambda: response_chain.invoke({
+                "product_name": product_name,
+                "product_search_results": product_search_results
+            }).content
+        )
+
+        print(f"\n\nResponse: {response_content}")
 
         return {
-            **state,
-            "product_name": product_name,
             "product_search_results": product_search_results,
-            "current_node": "format_product_table",
-            "conversation_history": state["conversation_history"] + [
-                AIMessage(content=response.content)
-            ]
+            "product_search_summary": response_content
         }
     
     except Exception as e:
-        print("\nException in lookup_product_details:", repr(e))
-        # If the SKU cannot be found or something else goes wrong
-        not_found_prompt = ChatPromptTemplate.from_template(
-            """You are an audience building assistant for retail media.
-            
-            The user asked about Product Name {product_name}, but it could not be found in our database.
-            
-            Politely inform them that you couldn't find this Product and ask if they'd like to try a different product.
-
-            Respond as the assistant.
-            """
-        )
-
-        not_found_chain = not_found_prompt | llm
-        not_found_response = not_found_chain.invoke({"name": product_name})
+        print("\nException in summarise_products:", repr(e))
+        # If the product cannot be found or something else goes wrong
+        not_found_response = chain_registry.chain("product_not_found").invoke({"product_name": product_name})
         
         return {
-            **state,
-            "conversation_history": state["conversation_history"] + [
-                AIMessage(content=not_found_response.content)
-            ],
-            "current_node": END
+            "product_search_results": None,
+            "product_search_summary": not_found_response.content
         }
 
+def present_product_details(state: AudienceBuilderState) -> AudienceBuilderState:
+    # Join: the confirmation is already in the history, append the summary after it
+    found = state.get("product_search_results") is not None
+
+    return {
+        **state,
+        "conversation_history": state["conversation_history"] + [
+            AIMessage(content=state["product_search_summary"])
+        ],
+        "current_node": "format_product_table" if found else END
+    }
+
 # TODO: Mardown Table
 # TODO: react-chat-ui-kit, botframework-webchat, stream-chat-react
 def format_product_table(state: AudienceBuilderState) -> AudienceBuilderState:
@@ -222,25 +264,6 @@ def format_product_table(state: AudienceBuilderState) -> AudienceBuilderState:
     # Get the product search results from state
     product_search_results = state.get("product_search_results")
     
-    # Create a prompt template that takes the structured data
-    response_prompt = ChatPromptTemplate.from_template("""
-    You are a data formatter that creates clean, readable summaries from product data.
-    
-    Here are the search results for products:
-    
-    Buyer Categories: {buyer_categories}
-    Product Categories: {product_categories}
-    Total Results: {total_results}
-    
-    Sample products:
-    {sample_products}
-    
-    1. First, provide a brief summary of the search results.
-    2. Then, create a well-formatted markdown table showing the most relevant products.
-    3. Include columns for: Buyer Category, Product Category, SKU Number, Product Name.
-    4. Limit to showing at most 10 products total.
-    """)
-    
     # Format the product data for the prompt
     # Convert ProductDetails objects to strings for display in the prompt
     sample_products = []
@@ -249,8 +272,8 @@ def format_product_table(state: AudienceBuilderState) -> AudienceBuilderState:
             f"- {p.product_name} (SKU: {p.sku}, Buyer Category: {p.buyer_category}, Product Category: {p.product_category})"
         )
     
-    # Create the chain
-    response_chain = response_prompt | llm
+    # Look up the precompiled chain
+    response_chain = chain_registry.chain("format_product_table")
     
     # Invoke the chain with the formatted product data
     response = response_chain.invoke({
@@ -275,34 +298,88 @@ def format_product_table(state: AudienceBuilderState) -> AudienceBuilderState:
         "current_node": END
     }
 
+def timed(node):
+    """ Print how long each node takes, to read per-turn critical-path latency off the logs """
+    # wraps() exposes the node's own signature, so LangGraph passes config to
+    # nodes that declare it; forward whatever it passes
+    @wraps(node)
+    def wrapper(state: AudienceBuilderState, *args, **kwargs) -> AudienceBuilderState:
+        start = time.perf_counter()
+        try:
+            return node(state, *args, **kwargs)
+        finally:
+            print(f"\n[timing] {node.__name__} took {time.perf_counter() - start:.3f}s")
+
+    return wrapper
+
+PRODUCT_BRANCHES = ["confirm_product", "lookup_product_details"]
+
+# State keys the lookup subgraph hands back to the parent graph
+LOOKUP_KEYS = ["product_search_results", "category_facets", "product_search_summary"]
+
+def route_identified_product(state: AudienceBuilderState):
+    # A list of nodes makes LangGraph run them as parallel branches
+    if state["current_node"] == "lookup_product_details":
+        return PRODUCT_BRANCHES
+    return state["current_node"]
+
+def create_lookup_workflow():
+    # Runs as a single node of the parent graph, so the summary LLM call
+    # overlaps confirm_product instead of waiting for the parent's next step
+    lookup = StateGraph(AudienceBuilderState)
+
+    lookup.add_node("search_products", timed(search_products))
+    lookup.add_node("expand_categories", timed(expand_categories))
+    lookup.add_node("summarise_products", timed(summarise_products))
+
+    lookup.add_edge(START, "search_products")
+    lookup.add_edge(START, "expand_categories")
+    lookup.add_edge(["search_products", "expand_categories"], "summarise_products")
+    lookup.add_edge("summarise_products", END)
+
+    return lookup.compile()
+
 def create_workflow():
     workflow = StateGraph(AudienceBuilderState)
+    lookup_workflow = create_lookup_workflow()
+
+    def lookup_product_details(state: AudienceBuilderState, config: RunnableConfig) -> AudienceBuilderState:
+        # Run under the parent's config so callbacks, tracing and the recursion
+        # limit carry into the subgraph, and hand back only the lookup branch's
+        # keys so they merge with confirm_product's
+        result = lookup_workflow.invoke(state, config)
+        return {key: result.get(key) for key in LOOKUP_KEYS}
     
-    workflow.add_node("greet", greet)
-    workflow.add_node("identify_product", identify_product)
-    workflow.add_node("lookup_product_details", lookup_product_details)
-    workflow.add_node("format_product_table", format_product_table)
+    workflow.add_node("greet", timed(greet))
+    workflow.add_node("identify_product", timed(identify_product))
+    workflow.add_node("confirm_product", timed(confirm_product))
+    workflow.add_node("lookup_product_details", timed(lookup_product_details))
+    workflow.add_node("present_product_details", timed(present_product_details))
+    workflow.add_node("format_product_table", timed(format_product_table))
     
     # Edge: greet -> identify_product
     workflow.add_edge("greet", "identify_product")
     
-    # Edge from identify_product depends on its "current_node" output
+    # Edge from identify_product depends on its "current_node" output; a
+    # found product fans out to the parallel branches
     workflow.add_conditional_edges(
         "identify_product",
-        lambda x: x["current_node"],
+        route_identified_product,
         {
             "identify_product": "identify_product",
-            "lookup_product_details": "lookup_product_details",
+            **{branch: branch for branch in PRODUCT_BRANCHES},
             END: END
         }
     )
 
-    # Now set up the edges for lookup_product_details
+    # Join: present_product_details waits for both branches to finish
+    workflow.add_edge(PRODUCT_BRANCHES, "present_product_details")
+
+    # Now set up the edges for present_product_details
     workflow.add_conditional_edges(
-        "lookup_product_details",
+        "present_product_details",
         lambda x: x["current_node"],
         {
-            "identify_product": "identify_product",
             "format_product_table": "format_product_table",
             END: END
         }
@@ -320,6 +397,8 @@ def get_initial_state():
         "product_category": None,
         "buyer_category": None,
         "product_search_results": None,
+        "category_facets": None,
+        "product_search_summary": None,
         "current_node": "greet",
         
         
@@ -0,0 +1,322 @@
+import csv
+import time
+import sqlite3
+import argparse
+from decimal import Decimal, InvalidOperation
+from typing import Iterator, List, Optional, Tuple
+
+from tools import DB_PATH, SEARCH_INDEX, catalogue_version
+from catalogue_snapshot import SNAPSHOT_PATH, build_snapshot
+
+# Streams a catalogue extract (CSV or Parquet) into DIM_ITEMS:
+#   - rows are read and written in chunks, never the whole file at once
+#   - each chunk is staged, diffed against DIM_ITEMS, and only new or changed
+#     SKUs are upserted, inside one transaction per chunk
+#   - WAL mode lets the app keep reading while a refresh is running
+#   - the trigram search index is updated for the changed SKUs only
+#   - with --full-refresh, SKUs missing from the extract are deleted from
+#     DIM_ITEMS and the search index once every chunk has been applied
+#   - CATALOGUE_META.version is bumped when anything changed, so caches keyed
+#     on the version drop stale results
+
+COLUMNS = ("skuId", "skuName", "catLevel4Name", "catLevel5Name")
+DEFAULT_CHUNK_SIZE = 50_000
+
+Row = Tuple[int, Optional[str], Optional[str], Optional[str]]
+
+
+def _sku(value) -> Optional[int]:
+    """ The SKU as an int, or None unless it is integral: 12, 12.0 and "12.0" pass, 12.7 does not """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    # CSV gives strings and Parquet may give floats; read both exactly rather than truncating
+    try:
+        number = Decimal(str(value).strip())
+    except InvalidOperation:
+        return None
+    if not number.is_finite() or number != number.to_integral_value():
+        return None
+    return int(number)
+
+
+def _clean(row) -> Optional[Row]:
+    """ Coerce one source record, or None if it has no integer SKU """
+    sku = _sku(row[0])
+    if sku is None:
+        return None
+    return (sku, *[value if value != "" else None for value in row[1:]])
+
+
+def read_csv_chunks(path: str, chunk_size: int) -> Iterator[List[tuple]]:
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        missing = set(COLUMNS) - set(reader.fieldnames or [])
+        if missing:
+            raise ValueError(f"{path} is missing columns: {', '.join(sorted(missing))}")
+
+        chunk = []
+        for record in reader:
+            chunk.append(tuple(record[column] for column in COLUMNS))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def read_parquet_chunks(path: str, chunk_size: int) -> Iterator[List[tuple]]:
+    try:
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("Reading Parquet catalogues requires pyarrow: pip install pyarrow") from e
+
+    parquet_file = pq.ParquetFile(path)
+    for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=list(COLUMNS)):
+        columns = [batch.column(column).to_pylist() for column in COLUMNS]
+        yield list(zip(*columns))
+
+
+def read_chunks(path: str, chunk_size: int) -> Iterator[List[tuple]]:
+    if path.lower().endswith((".parquet", ".pq")):
+        return read_parquet_chunks(path, chunk_size)
+    return read_csv_chunks(path, chunk_size)
+
+
+def check_sku_ids(conn: sqlite3.Connection):
+    """ Report non-integer and duplicate skuIds that would break the SKU index """
+    problems = []
+
+    non_integer = conn.execute(
+        "SELECT skuId FROM DIM_ITEMS WHERE typeof(skuId) != 'integer'"
+    ).fetchall()
+    if non_integer:
+        examples = ", ".join(repr(sku) for sku, in non_integer[:5])
+        problems.append(f"{len(non_integer)} non-integer skuId values (e.g. {examples})")
+
+    duplicates = conn.execute(
+        "SELECT skuId, COUNT(*) FROM DIM_ITEMS GROUP BY skuId HAVING COUNT(*) > 1"
+    ).fetchall()
+    if duplicates:
+        examples = ", ".join(f"{sku!r} x{count}" for sku, count in duplicates[:5])
+        problems.append(f"{len(duplicates)} duplicated skuId values (e.g. {examples})")
+
+    if problems:
+        raise ValueError(
+            "DIM_ITEMS cannot be indexed by skuId: " + "; ".join(problems)
+            + ". Fix these rows before ingesting."
+        )
+
+
+def prepare_database(conn: sqlite3.Connection):
+    """ Switch to WAL and create the tables and indexes ingestion relies on """
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS DIM_ITEMS (
+        skuId INTEGER,
+        skuName TEXT,
+        catLevel4Name TEXT,
+        catLevel5Name TEXT
+    )
+    """)
+
+    has_sku_index = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_dim_items_sku'"
+    ).fetchone()
+    if not has_sku_index:
+        # First run against an existing catalogue: the unique index and the
+        # search index (rowid = skuId) both need one integer row per SKU
+        check_sku_ids(conn)
+
+    conn.executescript("""
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_dim_items_sku ON DIM_ITEMS(skuId);
+    CREATE INDEX IF NOT EXISTS idx_dim_items_l4 ON DIM_ITEMS(catLevel4Name);
+    CREATE INDEX IF NOT EXISTS idx_dim_items_l5 ON DIM_ITEMS(catLevel5Name);
+
+    CREATE TABLE IF NOT EXISTS CATALOGUE_META (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+
+    CREATE TEMP TABLE IF NOT EXISTS staging (
+        skuId INTEGER PRIMARY KEY,
+        skuName TEXT,
+        catLevel4Name TEXT,
+        catLevel5Name TEXT
+    );
+    CREATE TEMP TABLE IF NOT EXISTS changed (
+        skuId INTEGER PRIMARY KEY,
+        is_new INTEGER
+    );
+    CREATE TEMP TABLE IF NOT EXISTS seen (
+        skuId INTEGER PRIMARY KEY
+    );
+    """)
+
+    has_index = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (SEARCH_INDEX,)
+    ).fetchone()
+    if not has_index:
+        # First run against an existing catalogue: index what is already there
+        print(f"Building {SEARCH_INDEX} from existing DIM_ITEMS")
+        with conn:
+            conn.execute(f"CREATE VIRTUAL TABLE {SEARCH_INDEX} USING fts5(skuName, tokenize='trigram')")
+            conn.execute(f"""
+            INSERT INTO {SEARCH_INDEX}(rowid, skuName)
+            SELECT skuId, skuName FROM DIM_ITEMS WHERE skuName IS NOT NULL
+            """)
+
+
+def upsert_chunk(conn: sqlite3.Connection, rows: List[Row], track_seen: bool = False) -> Tuple[int, int]:
+    """ Upsert the rows that differ from DIM_ITEMS; returns (inserted, updated) """
+    with conn:
+        conn.execute("DELETE FROM staging")
+        conn.execute("DELETE FROM changed")
+        # Later duplicates of a SKU within the chunk win
+        conn.executemany("INSERT OR REPLACE INTO staging VALUES (?, ?, ?, ?)", rows)
+
+        if track_seen:
+            # Every SKU in the extract, changed or not, for delete_missing
+            conn.execute("INSERT OR IGNORE INTO seen SELECT skuId FROM staging")
+
+        conn.execute("""
+        INSERT INTO changed (skuId, is_new)
+        SELECT s.skuId, d.skuId IS NULL
+        FROM staging s
+        LEFT JOIN DIM_ITEMS d ON d.skuId = s.skuId
+        WHERE d.skuId IS NULL
+           OR d.skuName IS NOT s.skuName
+           OR d.catLevel4Name IS NOT s.catLevel4Name
+           OR d.catLevel5Name IS NOT s.catLevel5Name
+        """)
+
+        inserted, updated = conn.execute(
+            "SELECT COALESCE(SUM(is_new), 0), COALESCE(SUM(1 - is_new), 0) FROM changed"
+        ).fetchone()
+        if not inserted and not updated:
+            return 0, 0
+
+        conn.execute("""
+        INSERT INTO DIM_ITEMS (skuId, skuName, catLevel4Name, catLevel5Name)
+        SELECT skuId, skuName, catLevel4Name, catLevel5Name
+        FROM staging
+        WHERE skuId IN (SELECT skuId FROM changed)
+        ON CONFLICT(skuId) DO UPDATE SET
+            skuName = excluded.skuName,
+            catLevel4Name = excluded.catLevel4Name,
+            catLevel5Name = excluded.catLevel5Name
+        """)
+
+        # Reindex only the SKUs whose rows changed
+        conn.execute(f"DELETE FROM {SEARCH_INDEX} WHERE rowid IN (SELECT skuId FROM changed)")
+        conn.execute(f"""
+        INSERT INTO {SEARCH_INDEX}(rowid, skuName)
+        SELECT skuId, skuName FROM staging
+        WHERE skuId IN (SELECT skuId FROM changed) AND skuName IS NOT NULL
+        """)
+
+    return inserted, updated
+
+
+def delete_missing(conn: sqlite3.Connection) -> int:
+    """ Delete SKUs that were not in the extract; returns how many were removed """
+    with conn:
+        conn.execute(f"""
+        DELETE FROM {SEARCH_INDEX}
+        WHERE rowid IN (SELECT skuId FROM DIM_ITEMS WHERE skuId NOT IN (SELECT skuId FROM seen))
+        """)
+        deleted = conn.execute(
+            "DELETE FROM DIM_ITEMS WHERE skuId NOT IN (SELECT skuId FROM seen)"
+        ).rowcount
+    return deleted
+
+
+def bump_catalogue_version(conn: sqlite3.Connection) -> int:
+    version = catalogue_version(conn) + 1
+    with conn:
+        conn.execute(
+            "INSERT INTO CATALOGUE_META (key, value) VALUES ('version', ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (str(version),)
+        )
+    return version
+
+
+def ingest(
+    source: str,
+    db_path: str = DB_PATH,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    snapshot_path: Optional[str] = SNAPSHOT_PATH,
+    full_refresh: bool = False,
+) -> dict:
+    """ Stream a catalogue extract into DIM_ITEMS and report throughput """
+    start = time.perf_counter()
+    read = skipped = inserted = updated = deleted = 0
+
+    conn = sqlite3.connect(db_path)
+    try:
+        prepare_database(conn)
+
+        for chunk in read_chunks(source, chunk_size):
+            rows = []
+            for record in chunk:
+                row = _clean(record)
+                if row is None:
+                    skipped += 1
+                else:
+                    rows.append(row)
+
+            chunk_inserted, chunk_updated = upsert_chunk(conn, rows, track_seen=full_refresh)
+            read += len(chunk)
+            inserted += chunk_inserted
+            updated += chunk_updated
+
+            elapsed = time.perf_counter() - start
+            print(f"Read {read} rows ({read / elapsed:,.0f} rows/sec): {inserted} inserted, {updated} updated")
+
+        if full_refresh:
+            if not read - skipped:
+                # An empty or unreadable extract must not wipe the catalogue
+                raise ValueError(f"{source} has no valid rows; refusing to delete every SKU in a full refresh")
+            deleted = delete_missing(conn)
+            print(f"Deleted {deleted} SKUs missing from {source}")
+
+        changed = inserted or updated or deleted
+        version = catalogue_version(conn)
+        if changed:
+            version = bump_catalogue_version(conn)
+            conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    finally:
+        conn.close()
+
+    if changed and snapshot_path:
+        build_snapshot(db_path, snapshot_path)
+
+    elapsed = time.perf_counter() - start
+    stats = {
+        "rows_read": read,
+        "rows_skipped": skipped,
+        "rows_inserted": inserted,
+        "rows_updated": updated,
+        "rows_deleted": deleted,
+        "catalogue_version": version,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(read / elapsed) if elapsed else 0,
+    }
+    print(f"Ingested {source} into {db_path}: {stats}")
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream a CSV or Parquet catalogue extract into DIM_ITEMS")
+    parser.add_argument("source", help="CSV or Parquet file with skuId, skuName, catLevel4Name, catLevel5Name")
+    parser.add_argument("--db", default=DB_PATH, help="SQLite catalogue database")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Rows per transaction")
+    parser.add_argument("--snapshot", default=SNAPSHOT_PATH, help="Rebuild this catalogue snapshot when rows change")
+    parser.add_argument("--full-refresh", action="store_true", help="Delete SKUs that are not in the extract")
+    args = parser.parse_args()
+
+    ingest(args.source, args.db, args.chunk_size, args.snapshot, args.full_refresh)
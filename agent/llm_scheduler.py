@@ -0,0 +1,275 @@
+import os
+import time
+import heapq
+import random
+import itertools
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, Optional
+
+import openai
+from langchain_core.language_models import LanguageModelInput
+
+# Each model tier has its own Azure deployment and quota, so the router gives
+# each tier one scheduler that enforces that deployment's budgets for the
+# whole process:
+#   - at most max_concurrency requests in flight
+#   - requests_per_minute / tokens_per_minute token buckets
+#   - interactive turns are admitted before background summaries, but a
+#     background call that has waited aging_seconds competes as interactive,
+#     so a steady flow of interactive calls cannot starve it
+#   - 429 / 5xx / connection errors are retried with jittered backoff, and a
+#     Retry-After from Azure pauses admission for everyone, not just the caller
+
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+# Rough chars-per-token for budgeting before the real usage is known
+CHARS_PER_TOKEN = 4
+DEFAULT_COMPLETION_TOKENS = 512
+
+
+class _TokenBucket:
+    """ Refills `per_minute` units evenly over a minute """
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        self.tokens -= amount
+
+
+class _Ticket:
+    def __init__(self, priority: int, tokens: int):
+        self.priority = priority
+        self.tokens = tokens
+        self.enqueued = time.monotonic()
+
+
+def _status_code(error: BaseException) -> Optional[int]:
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status
+
+
+def _retry_after(error: BaseException) -> Optional[float]:
+    """ Seconds the server asked us to wait, from retry-after-ms or Retry-After """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000.0
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                return None
+    return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    status = _status_code(error)
+    return status is not None and (status == 429 or status >= 500)
+
+
+class LLMScheduler:
+    """ Admission control, prioritisation and retries for chat model calls """
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        max_retries: int = 5,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+        aging_seconds: float = 2.0,
+    ):
+        self.max_concurrency = max_concurrency
+        self.aging_seconds = aging_seconds
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._requests = _TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._tokens = _TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+        self._cond = threading.Condition()
+        self._queue = []
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._paused_until = 0.0
+
+        self._metrics = {
+            "requests": 0,
+            "retries": 0,
+            "rate_limited": 0,
+            "failures": 0,
+            "queue_wait_seconds": 0.0,
+        }
+
+    @classmethod
+    def from_env(cls, tier: Optional[str] = None) -> "LLMScheduler":
+        """ Limits from LLM_* variables; LLM_<NAME>_<TIER> overrides them for one tier """
+        def env_int(name: str) -> Optional[int]:
+            if tier:
+                value = os.getenv(f"{name}_{tier.upper()}")
+                if value:
+                    return int(value)
+            value = os.getenv(name)
+            return int(value) if value else None
+
+        # Only unset variables fall back to the defaults: LLM_MAX_RETRIES=0 means no retries
+        max_concurrency = env_int("LLM_MAX_CONCURRENCY")
+        max_retries = env_int("LLM_MAX_RETRIES")
+        if max_concurrency is not None and max_concurrency < 1:
+            raise ValueError(f"LLM_MAX_CONCURRENCY must be at least 1, got {max_concurrency}")
+
+        return cls(
+            max_concurrency=8 if max_concurrency is None else max_concurrency,
+            requests_per_minute=env_int("LLM_REQUESTS_PER_MINUTE"),
+            tokens_per_minute=env_int("LLM_TOKENS_PER_MINUTE"),
+            max_retries=5 if max_retries is None else max_retries,
+        )
+
+    def _age(self, now: float):
+        """ Promote background tickets that have waited aging_seconds to interactive """
+        promoted = False
+        for i, (priority, seq, ticket) in enumerate(self._queue):
+            if priority > INTERACTIVE and now - ticket.enqueued >= self.aging_seconds:
+                # Keeping the arrival sequence puts it ahead of later interactive calls
+                self._queue[i] = (INTERACTIVE, seq, ticket)
+                promoted = True
+        if promoted:
+            heapq.heapify(self._queue)
+
+    def _admission_wait(self, ticket: _Ticket, now: float) -> Optional[float]:
+        """ 0 if the ticket can start now, else how long to wait (None: until notified) """
+        if self._queue[0][2] is not ticket or self._in_flight >= self.max_concurrency:
+            return None
+
+        waits = [self._paused_until - now]
+        if self._requests:
+            waits.append(self._requests.wait_time(1, now))
+        if self._tokens:
+            waits.append(self._tokens.wait_time(ticket.tokens, now))
+        return max(0.0, *waits)
+
+    def _acquire(self, ticket: _Ticket):
+        with self._cond:
+            heapq.heappush(self._queue, (ticket.priority, next(self._seq), ticket))
+            while True:
+                now = time.monotonic()
+                self._age(now)
+                wait = self._admission_wait(ticket, now)
+                if wait == 0.0:
+                    break
+                self._cond.wait(timeout=wait)
+
+            heapq.heappop(self._queue)
+            self._in_flight += 1
+            if self._requests:
+                self._requests.consume(1)
+            if self._tokens:
+                self._tokens.consume(ticket.tokens)
+            self._metrics["queue_wait_seconds"] += now - ticket.enqueued
+            self._cond.notify_all()
+
+    def _release(self, ticket: _Ticket, used_tokens: Optional[int] = None, pause: float = 0.0):
+        with self._cond:
+            self._in_flight -= 1
+            if self._tokens and used_tokens is not None:
+                # Correct the estimate we charged on admission
+                self._tokens.consume(used_tokens - ticket.tokens)
+            if pause:
+                self._paused_until = max(self._paused_until, time.monotonic() + pause)
+            self._cond.notify_all()
+
+    def _backoff(self, attempt: int, error: BaseException) -> float:
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return retry_after
+        # Full jitter keeps the waiting chats from retrying in lockstep
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, fn: Callable[[], Any], priority: int = INTERACTIVE, estimated_tokens: int = DEFAULT_COMPLETION_TOKENS) -> Any:
+        """ Run fn once admitted, retrying rate limits and transient failures """
+        attempt = 0
+        while True:
+            ticket = _Ticket(priority, estimated_tokens)
+            self._acquire(ticket)
+            with self._cond:
+                self._metrics["requests"] += 1
+
+            try:
+                result = fn()
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    self._release(ticket)
+                    with self._cond:
+                        self._metrics["failures"] += 1
+                    raise
+
+                delay = self._backoff(attempt, e)
+                rate_limited = _status_code(e) == 429
+                # A 429 means the deployment is saturated: hold back every caller
+                self._release(ticket, pause=delay if rate_limited else 0.0)
+                with self._cond:
+                    self._metrics["retries"] += 1
+                    if rate_limited:
+                        self._metrics["rate_limited"] += 1
+
+                print(f"LLM call failed ({e!r}), retrying in {delay:.2f}s (attempt {attempt + 1}/{self.max_retries})")
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            usage = getattr(result, "usage_metadata", None) or {}
+            self._release(ticket, usage.get("total_tokens"))
+            return result
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._cond:
+            queue_depth = {name: 0 for name in PRIORITY_NAMES.values()}
+            for _, _, ticket in self._queue:
+                queue_depth[PRIORITY_NAMES.get(ticket.priority, str(ticket.priority))] += 1
+
+            return {
+                **self._metrics,
+                "queue_depth": queue_depth,
+                "in_flight": self._in_flight,
+                "max_concurrency": self.max_concurrency,
+                "paused_for_seconds": max(0.0, self._paused_until - time.monotonic()),
+            }
+
+
+def estimate_tokens(input: LanguageModelInput) -> int:
+    return len(str(input)) // CHARS_PER_TOKEN + DEFAULT_COMPLETION_TOKENS
@@ -0,0 +1,246 @@
+import os
+import time
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.messages import BaseMessage
+from langchain_core.language_models import LanguageModelInput
+from langchain_core.exceptions import OutputParserException
+
+from llm_scheduler import LLMScheduler, INTERACTIVE, estimate_tokens
+
+# Nodes pick a model tier rather than a deployment: extraction needs the
+# strong model, while greetings and confirmations are fine on a small one.
+STRONG = "strong"
+FAST = "fast"
+
+TIER_DEPLOYMENTS = {
+    STRONG: os.getenv("DEPLOYMENT_NAME_STRONG", "gpt-4o"),
+    FAST: os.getenv("DEPLOYMENT_NAME_FAST", "gpt-4o-mini"),
+}
+
+# USD per 1M (input, output) tokens by deployment, for cost reporting only.
+# DEPLOYMENT_PRICE_STRONG / _FAST="input,output" price a deployment not listed
+# here; a tier with no known price reports no cost rather than a wrong one.
+DEPLOYMENT_PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+}
+
+
+def parse_price(value: Optional[str]) -> Optional[Tuple[float, float]]:
+    """ Parse "input,output" USD per 1M tokens """
+    if not value:
+        return None
+    try:
+        input_price, output_price = (float(part) for part in value.split(","))
+    except ValueError as e:
+        raise ValueError(f"Expected a price like '2.50,10.00', got {value!r}") from e
+    return input_price, output_price
+
+
+def tier_prices(deployments: Dict[str, str] = TIER_DEPLOYMENTS) -> Dict[str, Optional[Tuple[float, float]]]:
+    """ Each tier's price: its DEPLOYMENT_PRICE_<TIER> override, else its deployment's list price """
+    return {
+        tier: parse_price(os.getenv(f"DEPLOYMENT_PRICE_{tier.upper()}")) or DEPLOYMENT_PRICES.get(deployment)
+        for tier, deployment in deployments.items()
+    }
+
+
+TIER_PRICES = tier_prices()
+
+
+def parse_node_tiers(value: Optional[str]) -> Dict[str, str]:
+    """ Parse overrides like "greet=strong,identify_product=fast" """
+    overrides = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            node, tier = (part.strip() for part in item.split("=", 1))
+            if tier not in TIER_DEPLOYMENTS:
+                raise ValueError(f"Unknown model tier {tier!r} for node {node!r}")
+            overrides[node] = tier
+    return overrides
+
+
+class _NodeMetrics:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.model_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cost = 0.0
+
+
+class RoutedChatModel(Runnable[LanguageModelInput, BaseMessage]):
+    """ A tier's model as seen by one node, recording latency and cost per call """
+
+    def __init__(
+        self,
+        router: "ModelRouter",
+        node: str,
+        tier: str,
+        model: Runnable,
+        scheduler: Optional[LLMScheduler] = None,
+        priority: int = INTERACTIVE,
+    ):
+        self.router = router
+        self.node = node
+        self.tier = tier
+        self.model = model
+        self.scheduler = scheduler
+        self.priority = priority
+
+    def invoke(self, input: LanguageModelInput, config: Optional[RunnableConfig] = None, **kwargs: Any) -> BaseMessage:
+        # Time each attempt inside the scheduler, so the model's latency is
+        # not mixed up with queueing and retry backoff
+        model_seconds = 0.0
+
+        def attempt() -> BaseMessage:
+            nonlocal model_seconds
+            attempt_start = time.perf_counter()
+            try:
+                return self.model.invoke(input, config, **kwargs)
+            finally:
+                model_seconds += time.perf_counter() - attempt_start
+
+        start = time.perf_counter()
+        try:
+            if self.scheduler is None:
+                response = attempt()
+            else:
+                response = self.scheduler.call(attempt, self.priority, estimate_tokens(input))
+        except Exception:
+            self.router.record_error(self.node, self.tier)
+            raise
+
+        self.router.record(self.node, self.tier, model_seconds, time.perf_counter() - start - model_seconds, response)
+        return response
+
+
+class ParsedChain:
+    """ A node's parsing chain, re-run on the strong tier when the reply doesn't parse """
+
+    def __init__(self, router: "ModelRouter", node: str, tier: str, chain: Runnable, fallback: Optional[Runnable]):
+        self.router = router
+        self.node = node
+        self.tier = tier
+        self.chain = chain
+        self.fallback = fallback
+
+    def invoke(self, inputs: Dict[str, Any]) -> Any:
+        try:
+            return self.chain.invoke(inputs)
+        except OutputParserException as e:
+            if self.fallback is None:
+                raise
+            print(f"Parse failure on {self.tier} tier for {self.node}, falling back to {STRONG}: {e!r}")
+            self.router.record_fallback(self.node)
+            return self.fallback.invoke(inputs)
+
+
+class ModelRouter:
+    """ Map graph nodes to model tiers, with fallback to the strong tier on parse failures """
+
+    def __init__(
+        self,
+        models: Dict[str, Runnable],
+        node_tiers: Dict[str, str],
+        default_tier: str = STRONG,
+        node_priorities: Optional[Dict[str, int]] = None,
+        schedulers: Optional[Dict[str, LLMScheduler]] = None,
+        prices: Dict[str, Optional[Tuple[float, float]]] = TIER_PRICES,
+    ):
+        self.models = models
+        self.node_tiers = node_tiers
+        self.default_tier = default_tier
+        self.node_priorities = node_priorities or {}
+        self.schedulers = schedulers or {}
+        self.prices = prices
+
+        self._routes: Dict[tuple, RoutedChatModel] = {}
+        self._metrics: Dict[tuple, _NodeMetrics] = {}
+        self._fallbacks: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def tier_for(self, node: str) -> str:
+        return self.node_tiers.get(node, self.default_tier)
+
+    def for_node(self, node: str, tier: Optional[str] = None) -> RoutedChatModel:
+        """ The chat model a node should call, scheduled at the node's priority """
+        tier = tier or self.tier_for(node)
+        with self._lock:
+            route = self._routes.get((node, tier))
+            if route is None:
+                route = self._routes[(node, tier)] = RoutedChatModel(
+                    self, node, tier, self.models[tier],
+                    self.schedulers.get(tier), self.node_priorities.get(node, INTERACTIVE)
+                )
+            return route
+
+    def parsed_chain(self, node: str, prompt: Runnable, parser: Runnable) -> "ParsedChain":
+        """ Compose prompt | model | parser once, with the strong-tier fallback alongside """
+        tier = self.tier_for(node)
+        fallback = None if tier == STRONG else prompt | self.for_node(node, STRONG) | parser
+        return ParsedChain(self, node, tier, prompt | self.for_node(node, tier) | parser, fallback)
+
+    def record_fallback(self, node: str):
+        with self._lock:
+            self._fallbacks[node] = self._fallbacks.get(node, 0) + 1
+
+    def record_error(self, node: str, tier: str):
+        """ A call that failed for good, after any scheduler retries """
+        with self._lock:
+            self._metrics.setdefault((node, tier), _NodeMetrics()).errors += 1
+
+    def record(self, node: str, tier: str, model_seconds: float, wait_seconds: float, response: Any):
+        usage = getattr(response, "usage_metadata", None) or {}
+        input_tokens = usage.get("input_tokens", 0)
+        output_tokens = usage.get("output_tokens", 0)
+        input_price, output_price = self.prices.get(tier) or (0.0, 0.0)
+
+        with self._lock:
+            metrics = self._metrics.setdefault((node, tier), _NodeMetrics())
+            metrics.calls += 1
+            metrics.model_seconds += model_seconds
+            metrics.wait_seconds += wait_seconds
+            metrics.input_tokens += input_tokens
+            metrics.output_tokens += output_tokens
+            metrics.cost += (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            nodes = {}
+            tiers = {}
+            for (node, tier), m in self._metrics.items():
+                nodes.setdefault(node, {})[tier] = {
+                    "calls": m.calls,
+                    "errors": m.errors,
+                    # Time in the model API, and time queued or backing off in the scheduler
+                    "avg_model_seconds": m.model_seconds / m.calls if m.calls else 0.0,
+                    "avg_wait_seconds": m.wait_seconds / m.calls if m.calls else 0.0,
+                    "input_tokens": m.input_tokens,
+                    "output_tokens": m.output_tokens,
+                    "cost_usd": round(m.cost, 6) if self.prices.get(tier) else None,
+                }
+                totals = tiers.setdefault(tier, {"calls": 0, "errors": 0, "model_seconds": 0.0, "wait_seconds": 0.0, "cost_usd": 0.0})
+                totals["calls"] += m.calls
+                totals["errors"] += m.errors
+                totals["model_seconds"] += m.model_seconds
+                totals["wait_seconds"] += m.wait_seconds
+                totals["cost_usd"] += m.cost
+
+            for tier, totals in tiers.items():
+                calls = totals["calls"]
+                totals["avg_model_seconds"] = totals.pop("model_seconds") / calls if calls else 0.0
+                totals["avg_wait_seconds"] = totals.pop("wait_seconds") / calls if calls else 0.0
+                totals["cost_usd"] = round(totals["cost_usd"], 6) if self.prices.get(tier) else None
+
+            return {
+                "node_tiers": {node: self.tier_for(node) for node in nodes},
+                "nodes": nodes,
+                "tiers": tiers,
+                "parse_fallbacks": dict(self._fallbacks),
+            }
@@ -21,9 +21,12 @@ class ProductSearchResults(BaseModel):
     total_results: int
     unique_buyer_categories: List[str]
     unique_product_categories: List[str]
+    buyer_category_counts: Dict[str, int] = Field(default_factory=dict, description="Matches per buyer category (L4) across all pages")
+    product_category_counts: Dict[str, int] = Field(default_factory=dict, description="Matches per product category (L5) across all pages")
     by_buyer_category: Dict[str, List[ProductDetails]]
     by_product_category: Dict[str, List[ProductDetails]]
     all_products: List[ProductDetails]
+    next_cursor: Optional[str] = Field(None, description="Cursor for the next page of results, if any")
 
 class AudienceBuilderState(TypedDict):
     conversation_history: Annotated[List[Union[HumanMessage, AIMessage, Dict]], "conversation history", "append"]
@@ -33,4 +36,5 @@ class AudienceBuilderState(TypedDict):
     buyer_category: Annotated[Optional[str], "Buyer category from DB"]
     product_search_results: Annotated[Optional[ProductSearchResults], "Product search results from DB"]
     product_search_summary: Annotated[Optional[str], "Summary of product search results"]
+    category_facets: Annotated[Optional[Dict], "Category counts across all matches from DB"]
     current_node: str
\ No newline at end of file
@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional
+
+# Single-flight coalescing: while a call for some key is in flight, identical
+# calls wait for it and share its result instead of running the work again.
+# Nothing is cached once the call finishes; the next caller runs it afresh.
+
+SINGLE_FLIGHT_REDIS_URL = os.getenv("SINGLE_FLIGHT_REDIS_URL")
+
+# All flights, by name, so their metrics can be reported together
+FLIGHTS: Dict[str, "SingleFlight"] = {}
+
+# Only the holder may release or extend a lock; checking and acting in one
+# script keeps a worker whose lock expired from touching the next holder's
+UNLOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+EXTEND_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """ Coalesce identical concurrent calls within this process """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+        FLIGHTS[name] = self
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """ Run fn for key, or wait for the identical call already running """
+        with self._lock:
+            self.calls += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._execute(key, fn)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+    def _execute(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        return fn()
+
+    def _record_remote_coalesce(self):
+        with self._lock:
+            self.coalesced += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._calls),
+                "coalesced_fraction": self.coalesced / self.calls if self.calls else 0.0,
+            }
+
+
+class RedisSingleFlight(SingleFlight):
+    """ Coalesce identical calls across worker processes with a Redis lock
+
+    Calls are first coalesced in-process; the one local leader then races the
+    other workers for a Redis lock. The lock holder runs the work and publishes
+    the serialized result briefly, while the others poll for it. The holder
+    extends the lock every lock_ttl / 3 for as long as the work runs, however
+    long LLM retries take; if the holder dies its lock expires after lock_ttl
+    and a waiter runs the work itself.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        redis,
+        serialize: Callable[[Any], str] = json.dumps,
+        deserialize: Callable[[str], Any] = json.loads,
+        lock_ttl: float = 30.0,
+        result_ttl: float = 5.0,
+        poll_interval: float = 0.05,
+    ):
+        super().__init__(name)
+        self.redis = redis
+        self.serialize = serialize
+        self.deserialize = deserialize
+        self.lock_ttl = lock_ttl
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self._unlock = redis.register_script(UNLOCK_SCRIPT)
+        self._extend = redis.register_script(EXTEND_SCRIPT)
+
+    def _keep_lock(self, lock_key: str, token: str, done: threading.Event):
+        """ Extend the lock until done is set or the lock is no longer ours """
+        while not done.wait(self.lock_ttl / 3):
+            try:
+                if not self._extend(keys=[lock_key], args=[token, int(self.lock_ttl * 1000)]):
+                    return
+            except Exception as e:
+                # Keep trying: the lock only lapses if Redis stays unreachable for lock_ttl
+                print(f"Single-flight {self.name} could not extend its lock: {e!r}")
+
+    def _keys(self, key: Hashable):
+        digest = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+        return f"singleflight:{self.name}:lock:{digest}", f"singleflight:{self.name}:result:{digest}"
+
+    def _execute(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        lock_key, result_key = self._keys(key)
+        token = uuid.uuid4().hex
+
+        while True:
+            if self.redis.set(lock_key, token, nx=True, px=int(self.lock_ttl * 1000)):
+                done = threading.Event()
+                keeper = threading.Thread(target=self._keep_lock, args=(lock_key, token, done), daemon=True)
+                keeper.start()
+                try:
+                    result = fn()
+                    self.redis.set(result_key, self.serialize(result), px=int(self.result_ttl * 1000))
+                    return result
+                finally:
+                    done.set()
+                    keeper.join()
+                    self._unlock(keys=[lock_key], args=[token])
+
+            # Another worker holds the lock: wait for its result or for the lock to go away
+            while self.redis.exists(lock_key):
+                time.sleep(self.poll_interval)
+
+            payload = self.redis.get(result_key)
+            if payload is not None:
+                self._record_remote_coalesce()
+                return self.deserialize(payload)
+
+
+def create_single_flight(
+    name: str,
+    serialize: Callable[[Any], str] = json.dumps,
+    deserialize: Callable[[str], Any] = json.loads,
+) -> SingleFlight:
+    """ Build a cross-worker flight when SINGLE_FLIGHT_REDIS_URL is set, else an in-process one """
+    if SINGLE_FLIGHT_REDIS_URL:
+        from redis import Redis
+
+        redis = Redis.from_url(SINGLE_FLIGHT_REDIS_URL, decode_responses=True)
+        return RedisSingleFlight(name, redis, serialize, deserialize)
+
+    return SingleFlight(name)
+
+
+def single_flight_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: flight.stats() for name, flight in FLIGHTS.items()}
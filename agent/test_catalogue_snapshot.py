@@ -0,0 +1,75 @@
+import os
+import sqlite3
+
+import pytest
+
+import catalogue_snapshot
+from catalogue_snapshot import CatalogueSnapshot, build_snapshot
+
+
+@pytest.fixture
+def snapshot(catalogue_db, tmp_path):
+    path = str(tmp_path / "catalogue.snap")
+    build_snapshot(catalogue_db, path)
+    return CatalogueSnapshot(path)
+
+
+def sqlite_category(db_path, column, category):
+    conn = sqlite3.connect(db_path)
+    try:
+        return [row[0] for row in conn.execute(
+            f"SELECT skuId FROM DIM_ITEMS WHERE {column} = ? ORDER BY skuId", (category,)
+        )]
+    finally:
+        conn.close()
+
+
+def test_sku_lookup(snapshot):
+    product = snapshot.get_sku("21")
+    assert product.product_name == "Chunky KitKat 21g"
+    assert product.product_category == "Prem Choc"
+    assert snapshot.get_sku(999) is None
+    assert snapshot.get_sku("not-a-sku") is None
+
+
+@pytest.mark.parametrize("category", ["Kit Kat", "Prem Choc", "Missing", ""])
+def test_category_lookup_matches_sqlite(snapshot, catalogue_db, category):
+    assert [p.sku for p in snapshot.by_product_category(category)] == \
+        sqlite_category(catalogue_db, "catLevel5Name", category)
+
+
+def test_null_category_is_none_and_never_matches(snapshot):
+    assert snapshot.get_sku(100).product_category is None
+    assert snapshot.by_product_category("") == []
+
+
+def test_non_integer_skus_fail_the_build(catalogue_db, tmp_path):
+    conn = sqlite3.connect(catalogue_db)
+    conn.execute("INSERT INTO DIM_ITEMS VALUES ('A-17', 'KitKat Bites', 'Sharing', 'Kit Kat')")
+    conn.commit()
+    conn.close()
+
+    path = str(tmp_path / "catalogue.snap")
+    with pytest.raises(ValueError, match="non-integer skuId"):
+        build_snapshot(catalogue_db, path)
+    assert not os.path.exists(path)
+
+
+def test_swapped_snapshot_is_remapped(catalogue_db, tmp_path, monkeypatch):
+    path = str(tmp_path / "catalogue.snap")
+    build_snapshot(catalogue_db, path)
+    monkeypatch.setattr(catalogue_snapshot, "_snapshot", None)
+    old = catalogue_snapshot.get_catalogue_snapshot(path)
+
+    conn = sqlite3.connect(catalogue_db)
+    conn.execute("INSERT INTO DIM_ITEMS VALUES (300, 'KitKat Bites', 'Sharing', 'Kit Kat')")
+    conn.commit()
+    conn.close()
+    build_snapshot(catalogue_db, path)
+    monkeypatch.setattr(catalogue_snapshot, "_snapshot_checked_at", 0.0)
+
+    new = catalogue_snapshot.get_catalogue_snapshot(path)
+    assert new is not old
+    assert new.get_sku(300) is not None
+    # Readers still holding the old mapping keep a consistent view
+    assert old.get_sku(300) is None and old.get_sku(21) is not None
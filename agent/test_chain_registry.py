@@ -0,0 +1,58 @@
+import os
+import threading
+
+import pytest
+
+import tools
+import chain_registry
+from chain_registry import ChainRegistry, top_queries, warm_up
+from model_router import ModelRouter, STRONG, FAST
+
+
+@pytest.fixture
+def query_log(tmp_path, monkeypatch):
+    path = str(tmp_path / "queries.log")
+    monkeypatch.setattr(tools, "QUERY_LOG_PATH", path)
+    return path
+
+
+def test_query_log_is_rotated_at_the_cap(query_log, monkeypatch):
+    monkeypatch.setattr(tools, "QUERY_LOG_MAX_BYTES", 100)
+
+    for _ in range(30):
+        tools.log_query("KitKat")
+    for _ in range(5):
+        tools.log_query("Mini Eggs")
+
+    assert os.path.getsize(query_log) < 100
+    assert os.path.getsize(f"{query_log}.1") < 100 + len("KitKat\n")
+    # Warm-up ranks across the live and the rotated file
+    assert top_queries(query_log, 2) == ["KitKat", "Mini Eggs"]
+
+
+def test_warm_up_serves_first_request_from_cache(catalogue_db, query_log, monkeypatch):
+    monkeypatch.setattr(tools, "DB_PATH", catalogue_db)
+    monkeypatch.setattr(chain_registry, "DB_PATH", catalogue_db)
+    monkeypatch.setattr(tools, "_local", threading.local())
+    monkeypatch.setattr(tools, "search_cache", tools.LRUCache(tools.SEARCH_CACHE_SIZE))
+    monkeypatch.setattr(tools, "facet_cache", tools.LRUCache(tools.SEARCH_CACHE_SIZE))
+    for query in ["Chunky KitKat", "Chunky KitKat", "Mini Eggs"]:
+        tools.log_query(query)
+
+    registry = ChainRegistry(ModelRouter(models={STRONG: None, FAST: None}, node_tiers={}))
+    timings = warm_up(registry, query_log, top_n=5)
+
+    assert set(timings) == {"database", "snapshot", "search_cache"}
+    # No connection left behind on the startup thread
+    assert getattr(tools._local, "conn", None) is None
+
+    queries = []
+    monkeypatch.setattr(tools, "fetch_product_page", lambda *args: queries.append(args))
+    monkeypatch.setattr(tools, "fetch_category_facets", lambda *args: queries.append(args))
+
+    results = registry.product_lookup.invoke({"name": "Chunky KitKat", "include_facets": False})
+    facets = tools.lookup_category_facets("Chunky KitKat")
+
+    assert queries == []
+    assert results.total_results == 5
+    assert facets["total_results"] == 5
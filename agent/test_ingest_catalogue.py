@@ -0,0 +1,112 @@
+import csv
+import sqlite3
+
+import pytest
+
+import tools
+from ingest_catalogue import _clean, ingest, prepare_database
+
+
+def write_extract(path, rows):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["skuId", "skuName", "catLevel4Name", "catLevel5Name"])
+        writer.writerows(rows)
+    return str(path)
+
+
+def skus(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return {sku for sku, in conn.execute("SELECT skuId FROM DIM_ITEMS")}
+    finally:
+        conn.close()
+
+
+def search(db_path, name):
+    conn = sqlite3.connect(db_path)
+    try:
+        products, _ = tools.fetch_product_page(conn, name, 100, None)
+        return {p.sku for p in products}
+    finally:
+        conn.close()
+
+
+def test_full_refresh_deletes_missing_skus(catalogue_db, tmp_path):
+    extract = write_extract(tmp_path / "extract.csv", [
+        (sku, f"KitKat {sku}g", "Single Confectionery", "Kit Kat") for sku in range(1, 21)
+    ] + [(300, "Crunchie", "Single Confectionery", "Honeycomb")])
+
+    stats = ingest(extract, catalogue_db, chunk_size=7, snapshot_path=None, full_refresh=True)
+
+    assert stats["rows_inserted"] == 1
+    assert stats["rows_deleted"] == 7
+    assert stats["catalogue_version"] == 1
+    assert skus(catalogue_db) == set(range(1, 21)) | {300}
+    # Removed from the trigram index too, not just DIM_ITEMS
+    assert search(catalogue_db, "Chunky") == set()
+    assert search(catalogue_db, "Mini Eggs") == set()
+    assert search(catalogue_db, "KitKat") == set(range(1, 21))
+
+
+def test_incremental_ingest_keeps_missing_skus(catalogue_db, tmp_path):
+    extract = write_extract(tmp_path / "extract.csv", [(300, "Crunchie", "Single Confectionery", "Honeycomb")])
+
+    stats = ingest(extract, catalogue_db, snapshot_path=None)
+
+    assert stats["rows_deleted"] == 0
+    assert len(skus(catalogue_db)) == 28
+
+
+def test_full_refresh_with_no_rows_deleted_reports_no_change(catalogue_db, tmp_path):
+    conn = sqlite3.connect(catalogue_db)
+    rows = conn.execute("SELECT skuId, skuName, catLevel4Name, catLevel5Name FROM DIM_ITEMS").fetchall()
+    conn.close()
+    extract = write_extract(tmp_path / "extract.csv", [["" if v is None else v for v in row] for row in rows])
+
+    stats = ingest(extract, catalogue_db, snapshot_path=None, full_refresh=True)
+
+    assert stats["rows_deleted"] == 0
+    assert stats["catalogue_version"] == 0
+
+
+def test_full_refresh_refuses_empty_extract(catalogue_db, tmp_path):
+    extract = write_extract(tmp_path / "extract.csv", [("not-a-sku", "KitKat", None, None)])
+
+    with pytest.raises(ValueError, match="no valid rows"):
+        ingest(extract, catalogue_db, snapshot_path=None, full_refresh=True)
+
+    assert len(skus(catalogue_db)) == 27
+
+
+def test_prepare_database_reports_bad_sku_ids(catalogue_db):
+    conn = sqlite3.connect(catalogue_db)
+    conn.executemany("INSERT INTO DIM_ITEMS VALUES (?, ?, ?, ?)", [
+        (5, "KitKat 5g copy", "Single Confectionery", "Kit Kat"),
+        ("A12", "Loose sweets", None, None),
+    ])
+    conn.commit()
+
+    with pytest.raises(ValueError) as excinfo:
+        prepare_database(conn)
+
+    message = str(excinfo.value)
+    assert "1 non-integer skuId values (e.g. 'A12')" in message
+    assert "1 duplicated skuId values (e.g. 5 x2)" in message
+    # Nothing was built on top of the bad rows
+    assert conn.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE name IN ('idx_dim_items_sku', ?)", (tools.SEARCH_INDEX,)
+    ).fetchone()[0] == 0
+    conn.close()
+
+
+@pytest.mark.parametrize("raw, sku", [
+    (12, 12), ("12", 12), (" 12 ", 12), (12.0, 12), ("12.0", 12), (2 ** 62, 2 ** 62),
+    (12.7, None), ("12.7", None), ("A12", None), ("", None), (None, None), (True, None), (float("nan"), None),
+])
+def test_clean_accepts_only_integral_skus(raw, sku):
+    row = _clean((raw, "KitKat", "Single Confectionery", ""))
+    if sku is None:
+        assert row is None
+    else:
+        assert row == (sku, "KitKat", "Single Confectionery", None)
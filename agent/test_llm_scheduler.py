@@ -0,0 +1,171 @@
+import time
+import threading
+
+import openai
+import pytest
+
+from llm_scheduler import LLMScheduler, INTERACTIVE, BACKGROUND
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not reached")
+        time.sleep(0.005)
+
+
+def test_from_env_keeps_explicit_zero(monkeypatch):
+    monkeypatch.setenv("LLM_MAX_RETRIES", "0")
+    monkeypatch.delenv("LLM_MAX_CONCURRENCY", raising=False)
+
+    scheduler = LLMScheduler.from_env()
+
+    assert scheduler.max_retries == 0
+    assert scheduler.max_concurrency == 8
+
+    monkeypatch.setenv("LLM_MAX_CONCURRENCY", "0")
+    with pytest.raises(ValueError):
+        LLMScheduler.from_env()
+
+
+def test_no_retries_when_max_retries_is_zero(fake_chat_server):
+    fake_chat_server.script = [(429, {"retry-after-ms": "10"})]
+    model = fake_chat_server.chat_model()
+    scheduler = LLMScheduler(max_retries=0)
+
+    with pytest.raises(openai.RateLimitError):
+        scheduler.call(lambda: model.invoke("hi"))
+
+    assert len(fake_chat_server.arrivals) == 1
+    assert scheduler.metrics()["failures"] == 1
+
+
+def test_retry_after_is_honoured(fake_chat_server):
+    fake_chat_server.script = [(429, {"Retry-After": "1"})]
+    model = fake_chat_server.chat_model()
+    scheduler = LLMScheduler(base_delay=0.001, max_delay=0.001)
+
+    response = scheduler.call(lambda: model.invoke("hi"))
+
+    first, second = fake_chat_server.arrivals
+    assert response.content == "ok"
+    # The header, not the millisecond jitter, decides the wait
+    assert second - first >= 1.0
+    metrics = scheduler.metrics()
+    assert metrics["retries"] == 1
+    assert metrics["rate_limited"] == 1
+    assert metrics["in_flight"] == 0
+
+
+def test_server_errors_back_off_with_jitter(fake_chat_server, monkeypatch):
+    fake_chat_server.script = [(500, {}), (503, {})]
+    model = fake_chat_server.chat_model()
+    scheduler = LLMScheduler(base_delay=0.05, max_delay=1.0)
+
+    delays = []
+    monkeypatch.setattr("llm_scheduler.random.uniform", lambda low, high: delays.append(high) or high)
+
+    assert scheduler.call(lambda: model.invoke("hi")).content == "ok"
+
+    # Exponential ceiling, no global pause for non-429 errors
+    assert delays == [0.05, 0.1]
+    assert len(fake_chat_server.arrivals) == 3
+    metrics = scheduler.metrics()
+    assert metrics["retries"] == 2
+    assert metrics["rate_limited"] == 0
+    assert metrics["paused_for_seconds"] == 0.0
+
+
+def test_rate_limit_pauses_every_caller(fake_chat_server):
+    fake_chat_server.script = [(429, {"retry-after-ms": "500"})]
+    model = fake_chat_server.chat_model()
+    scheduler = LLMScheduler()
+
+    first = threading.Thread(target=lambda: scheduler.call(lambda: model.invoke("first")))
+    first.start()
+    wait_until(lambda: scheduler.metrics()["rate_limited"] == 1)
+    assert scheduler.metrics()["paused_for_seconds"] > 0.3
+
+    # A caller arriving during the pause is held back, not sent to Azure
+    second = threading.Thread(target=lambda: scheduler.call(lambda: model.invoke("second")))
+    second.start()
+    first.join()
+    second.join()
+
+    rate_limited_at = fake_chat_server.arrivals[0]
+    assert len(fake_chat_server.arrivals) == 3
+    assert all(arrival - rate_limited_at >= 0.5 for arrival in fake_chat_server.arrivals[1:])
+
+
+def test_interactive_admitted_before_background():
+    scheduler = LLMScheduler(max_concurrency=1)
+    release = threading.Event()
+    order = []
+
+    blocker = threading.Thread(target=lambda: scheduler.call(release.wait))
+    blocker.start()
+    wait_until(lambda: scheduler.metrics()["in_flight"] == 1)
+
+    # Background queues first, interactive second
+    threads = []
+    for name, priority in (("background", BACKGROUND), ("interactive", INTERACTIVE)):
+        thread = threading.Thread(target=scheduler.call, args=(lambda name=name: order.append(name), priority))
+        thread.start()
+        threads.append(thread)
+        wait_until(lambda name=name: scheduler.metrics()["queue_depth"][name] == 1)
+
+    assert scheduler.metrics()["queue_depth"] == {"interactive": 1, "background": 1}
+
+    release.set()
+    for thread in [blocker, *threads]:
+        thread.join()
+
+    assert order == ["interactive", "background"]
+    metrics = scheduler.metrics()
+    assert metrics["queue_depth"] == {"interactive": 0, "background": 0}
+    assert metrics["in_flight"] == 0
+    assert metrics["requests"] == 3
+    assert metrics["queue_wait_seconds"] > 0
+
+
+def test_from_env_reads_per_tier_limits(monkeypatch):
+    monkeypatch.setenv("LLM_TOKENS_PER_MINUTE", "100000")
+    monkeypatch.setenv("LLM_TOKENS_PER_MINUTE_FAST", "20000")
+    monkeypatch.setenv("LLM_MAX_CONCURRENCY_STRONG", "2")
+    monkeypatch.delenv("LLM_MAX_CONCURRENCY", raising=False)
+
+    strong = LLMScheduler.from_env("strong")
+    fast = LLMScheduler.from_env("fast")
+
+    assert strong._tokens.capacity == 100000
+    assert fast._tokens.capacity == 20000
+    assert strong.max_concurrency == 2
+    assert fast.max_concurrency == 8
+
+
+def test_background_is_admitted_while_interactive_keeps_arriving():
+    scheduler = LLMScheduler(max_concurrency=1, aging_seconds=0.2)
+    stop = threading.Event()
+    admitted = {}
+
+    def interactive_caller():
+        while not stop.is_set():
+            scheduler.call(lambda: time.sleep(0.01), INTERACTIVE)
+
+    # More interactive callers than slots, so one is always queued
+    callers = [threading.Thread(target=interactive_caller) for _ in range(3)]
+    for caller in callers:
+        caller.start()
+    wait_until(lambda: scheduler.metrics()["queue_depth"]["interactive"] >= 1)
+
+    start = time.monotonic()
+    scheduler.call(lambda: admitted.setdefault("at", time.monotonic()), BACKGROUND)
+    still_arriving = scheduler.metrics()["queue_depth"]["interactive"] >= 1
+
+    stop.set()
+    for caller in callers:
+        caller.join()
+
+    assert still_arriving
+    assert 0.2 <= admitted["at"] - start < 1.0
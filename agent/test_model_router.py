@@ -0,0 +1,137 @@
+import time
+import threading
+
+import httpx
+import openai
+import pytest
+from langchain_core.exceptions import OutputParserException
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import Runnable
+
+import dialogue_manager
+from chain_registry import ChainRegistry
+from llm_scheduler import LLMScheduler
+from model_router import ModelRouter, STRONG, FAST, tier_prices
+
+IDENTIFIED = '{"mentioned": true, "product_name": "KitKat"}'
+
+
+class StubChatModel(Runnable):
+    """ Replies with each scripted item in turn; exceptions are raised """
+
+    def __init__(self, *replies, delay=0.0):
+        self.replies = list(replies)
+        self.delay = delay
+        self.calls = 0
+
+    def invoke(self, input, config=None, **kwargs):
+        self.calls += 1
+        time.sleep(self.delay)
+        reply = self.replies.pop(0) if len(self.replies) > 1 else self.replies[0]
+        if isinstance(reply, Exception):
+            raise reply
+        return AIMessage(content=reply)
+
+
+def test_unparseable_fast_reply_falls_back_to_strong():
+    fast, strong = StubChatModel("Sure! The product is KitKat."), StubChatModel(IDENTIFIED)
+    router = ModelRouter(models={STRONG: strong, FAST: fast}, node_tiers={"identify_product": FAST})
+
+    result = ChainRegistry(router).identify_product.invoke({"user_message": "KitKat please"})
+
+    assert result.product_name == "KitKat"
+    assert (fast.calls, strong.calls) == (1, 1)
+    metrics = router.metrics()
+    assert metrics["parse_fallbacks"] == {"identify_product": 1}
+    assert set(metrics["nodes"]["identify_product"]) == {FAST, STRONG}
+
+
+def test_default_routing_has_no_fallback_for_identify_product():
+    # identify_product already runs on the strong tier, so a bad reply surfaces
+    model = StubChatModel("not json")
+    router = ModelRouter(models={STRONG: model, FAST: model}, node_tiers=dialogue_manager.NODE_TIERS)
+    registry = ChainRegistry(router)
+
+    assert registry.identify_product.fallback is None
+    with pytest.raises(OutputParserException):
+        registry.identify_product.invoke({"user_message": "KitKat please"})
+    assert router.metrics()["parse_fallbacks"] == {}
+
+
+def test_queue_time_is_recorded_apart_from_model_time():
+    model = StubChatModel("hello", delay=0.2)
+    scheduler = LLMScheduler(max_concurrency=1)
+    router = ModelRouter(models={FAST: model}, node_tiers={"greet": FAST}, schedulers={FAST: scheduler})
+    route = router.for_node("greet")
+
+    threads = [threading.Thread(target=route.invoke, args=("hi",)) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    greet = router.metrics()["nodes"]["greet"][FAST]
+    assert greet["calls"] == 2
+    assert 0.18 <= greet["avg_model_seconds"] < 0.3
+    # One of the two calls queued behind the other for a full model call
+    assert greet["avg_wait_seconds"] * 2 >= 0.18
+
+
+def test_failed_calls_are_counted_as_errors():
+    connection_error = openai.APIConnectionError(request=httpx.Request("POST", "http://localhost"))
+    flaky = StubChatModel(connection_error, "hello")
+    broken = StubChatModel(ValueError("bad request"))
+    scheduler = LLMScheduler(base_delay=0.001, max_delay=0.001)
+    router = ModelRouter(
+        models={STRONG: broken, FAST: flaky},
+        node_tiers={"greet": FAST, "format_product_table": STRONG},
+        schedulers={FAST: scheduler, STRONG: scheduler}
+    )
+
+    # A retried call that finally succeeds is not an error
+    assert router.for_node("greet").invoke("hi").content == "hello"
+    with pytest.raises(ValueError):
+        router.for_node("format_product_table").invoke("hi")
+
+    metrics = router.metrics()
+    assert metrics["nodes"]["greet"][FAST]["errors"] == 0
+    assert metrics["nodes"]["format_product_table"][STRONG] == {
+        **metrics["nodes"]["format_product_table"][STRONG], "calls": 0, "errors": 1
+    }
+    assert metrics["tiers"][STRONG]["errors"] == 1
+    assert scheduler.metrics()["retries"] == 1
+
+
+def test_prices_follow_the_deployment(monkeypatch):
+    monkeypatch.delenv("DEPLOYMENT_PRICE_STRONG", raising=False)
+    monkeypatch.delenv("DEPLOYMENT_PRICE_FAST", raising=False)
+    deployments = {STRONG: "o1-preview", FAST: "gpt-4o"}
+
+    # The fast tier now runs gpt-4o and is priced as such; an unknown model has no price
+    assert tier_prices(deployments) == {STRONG: None, FAST: (2.50, 10.00)}
+
+    monkeypatch.setenv("DEPLOYMENT_PRICE_STRONG", "15,60")
+    assert tier_prices(deployments)[STRONG] == (15.0, 60.0)
+
+    monkeypatch.setenv("DEPLOYMENT_PRICE_FAST", "cheap")
+    with pytest.raises(ValueError):
+        tier_prices(deployments)
+
+
+def test_unpriced_tier_reports_no_cost():
+    reply = AIMessage(content="hello", usage_metadata={"input_tokens": 1000, "output_tokens": 100, "total_tokens": 1100})
+    model = StubChatModel("hello")
+    model.invoke = lambda *args, **kwargs: reply
+    router = ModelRouter(
+        models={STRONG: model, FAST: model},
+        node_tiers={"greet": FAST, "format_product_table": STRONG},
+        prices={FAST: (0.15, 0.60), STRONG: None}
+    )
+
+    router.for_node("greet").invoke("hi")
+    router.for_node("format_product_table").invoke("hi")
+
+    metrics = router.metrics()
+    assert metrics["tiers"][FAST]["cost_usd"] == round((1000 * 0.15 + 100 * 0.60) / 1_000_000, 6)
+    assert metrics["tiers"][STRONG]["cost_usd"] is None
+    assert metrics["nodes"]["format_product_table"][STRONG]["cost_usd"] is None
@@ -0,0 +1,178 @@
+import time
+import threading
+
+import fakeredis
+import pytest
+
+from singleflight import RedisSingleFlight, SingleFlight
+
+CALLERS = 20
+
+
+def run_concurrently(fn, callers=CALLERS):
+    """ Start every caller behind a barrier and collect results or errors """
+    barrier = threading.Barrier(callers)
+    results, errors = [], []
+    lock = threading.Lock()
+
+    def caller(i):
+        barrier.wait()
+        try:
+            result = fn(i)
+        except Exception as e:
+            with lock:
+                errors.append(e)
+        else:
+            with lock:
+                results.append(result)
+
+    threads = [threading.Thread(target=caller, args=(i,)) for i in range(callers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+def test_identical_concurrent_calls_share_one_execution():
+    flight = SingleFlight("test_share")
+    executions = []
+
+    def work():
+        executions.append(1)
+        time.sleep(0.2)
+        return {"rows": 42}
+
+    results, errors = run_concurrently(lambda i: flight.do("kitkat", work))
+
+    assert errors == []
+    assert len(executions) == 1
+    assert len(results) == CALLERS and all(r is results[0] for r in results)
+    stats = flight.stats()
+    assert stats["calls"] == CALLERS
+    assert stats["coalesced"] == CALLERS - 1
+    assert stats["coalesced_fraction"] == pytest.approx((CALLERS - 1) / CALLERS)
+    assert stats["in_flight"] == 0
+
+
+def test_exception_reaches_every_waiter():
+    flight = SingleFlight("test_errors")
+    executions = []
+
+    def work():
+        executions.append(1)
+        time.sleep(0.2)
+        raise ValueError("Product with name kitkat not found")
+
+    results, errors = run_concurrently(lambda i: flight.do("kitkat", work))
+
+    assert results == []
+    assert len(executions) == 1
+    assert len(errors) == CALLERS
+    assert all(isinstance(e, ValueError) for e in errors)
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_different_keys_do_not_coalesce():
+    flight = SingleFlight("test_keys")
+    results, errors = run_concurrently(lambda i: flight.do(i % 2, lambda: time.sleep(0.1) or "done"), callers=4)
+
+    assert errors == [] and len(results) == 4
+    assert flight.stats()["coalesced"] == 2
+
+
+def test_next_call_after_completion_runs_again():
+    flight = SingleFlight("test_sequential")
+    executions = []
+    flight.do("kitkat", lambda: executions.append(1))
+    flight.do("kitkat", lambda: executions.append(1))
+
+    assert len(executions) == 2
+    assert flight.stats()["coalesced"] == 0
+
+
+def test_redis_flight_coalesces_across_workers():
+    server = fakeredis.FakeServer()
+    # Two flights sharing one Redis stand in for two worker processes
+    workers = [
+        RedisSingleFlight("test_redis", fakeredis.FakeRedis(server=server, decode_responses=True), poll_interval=0.01)
+        for _ in range(2)
+    ]
+    executions = []
+
+    def work():
+        executions.append(1)
+        time.sleep(0.3)
+        return {"rows": 42}
+
+    results, errors = run_concurrently(lambda i: workers[i % 2].do("kitkat", work), callers=10)
+
+    assert errors == []
+    assert len(executions) == 1
+    assert results == [{"rows": 42}] * 10
+    assert sum(worker.stats()["coalesced"] for worker in workers) == 9
+    assert all(worker.stats()["in_flight"] == 0 for worker in workers)
+
+
+def test_redis_waiter_takes_over_when_holder_fails():
+    server = fakeredis.FakeServer()
+    holder, waiter = [
+        RedisSingleFlight("test_redis_fail", fakeredis.FakeRedis(server=server, decode_responses=True), poll_interval=0.01)
+        for _ in range(2)
+    ]
+    started = threading.Event()
+
+    def failing():
+        started.set()
+        time.sleep(0.2)
+        raise RuntimeError("worker crashed")
+
+    def run_holder():
+        with pytest.raises(RuntimeError):
+            holder.do("kitkat", failing)
+
+    thread = threading.Thread(target=run_holder)
+    thread.start()
+    started.wait()
+
+    assert waiter.do("kitkat", lambda: "recovered") == "recovered"
+    thread.join()
+
+
+def test_redis_lock_is_extended_while_work_runs():
+    server = fakeredis.FakeServer()
+    holder, waiter = [
+        RedisSingleFlight("test_redis_extend", fakeredis.FakeRedis(server=server, decode_responses=True), lock_ttl=0.2, poll_interval=0.01)
+        for _ in range(2)
+    ]
+    started = threading.Event()
+    executions = []
+
+    def slow_call():
+        executions.append(1)
+        started.set()
+        # Several lock TTLs, like an LLM call backing off through retries
+        time.sleep(0.8)
+        return "summary"
+
+    thread = threading.Thread(target=holder.do, args=("kitkat", slow_call))
+    thread.start()
+    started.wait()
+
+    assert waiter.do("kitkat", slow_call) == "summary"
+    thread.join()
+    assert len(executions) == 1
+
+
+def test_redis_holder_never_releases_a_lock_it_lost():
+    redis = fakeredis.FakeRedis(decode_responses=True)
+    flight = RedisSingleFlight("test_redis_lost", redis)
+    lock_key, _ = flight._keys("kitkat")
+
+    def work():
+        # The lock expired and another worker took it while this one ran
+        redis.set(lock_key, "other-worker")
+        return "done"
+
+    assert flight.do("kitkat", work) == "done"
+    assert redis.get(lock_key) == "other-worker"
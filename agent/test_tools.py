@@ -0,0 +1,95 @@
+import json
+import base64
+import sqlite3
+
+import pytest
+
+import tools
+
+
+def test_pages_cover_every_match_once(catalogue_db):
+    conn = sqlite3.connect(catalogue_db)
+    seen, cursor = [], None
+    while True:
+        products, cursor = tools.fetch_product_page(conn, "KitKat", 7, cursor)
+        seen += [p.sku for p in products]
+        if cursor is None:
+            break
+
+    assert len(seen) == len(set(seen)) == 26
+    # The exact name match ranks first
+    assert seen[0] == 100
+
+
+def test_iter_product_pages_matches_keyset_pages(catalogue_db, monkeypatch):
+    monkeypatch.setattr(tools, "DB_PATH", catalogue_db)
+    pages = list(tools.iter_product_pages("kitkat", page_size=10))
+
+    assert [len(products) for products, _ in pages] == [10, 10, 6]
+    assert pages[-1][1] is None
+
+    # Each page's cursor resumes exactly where the stream continues
+    resumed = list(tools.iter_product_pages("kitkat", page_size=10, cursor=pages[0][1]))
+    assert [p.sku for products, _ in resumed for p in products] == \
+        [p.sku for products, _ in pages[1:] for p in products]
+
+
+def test_iter_product_pages_exact_multiple_has_no_trailing_cursor(catalogue_db, monkeypatch):
+    monkeypatch.setattr(tools, "DB_PATH", catalogue_db)
+    pages = list(tools.iter_product_pages("chunky", page_size=5))
+
+    assert len(pages) == 1
+    assert pages[0][1] is None
+
+
+@pytest.mark.parametrize("payload", [[6, [1]], [6, {"a": 1}], ["6", 1], [6.5, 1], [True, 1], [6], "x"])
+def test_decode_cursor_rejects_non_scalar_values(payload):
+    cursor = base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+    with pytest.raises(ValueError):
+        tools.decode_cursor(cursor)
+
+
+def test_cursor_round_trip():
+    assert tools.decode_cursor(tools.encode_cursor(8, 1234)) == (8, 1234)
+    assert tools.decode_cursor(tools.encode_cursor(6, "A12")) == (6, "A12")
+
+
+def test_name_match_resolved_once_per_pooled_connection(catalogue_db):
+    from ingest_catalogue import prepare_database
+
+    conn = sqlite3.connect(catalogue_db, factory=tools.CatalogueConnection)
+    assert tools.name_match(conn) == tools.NAME_MATCH
+
+    # An index created later is still picked up, then remembered
+    setup = sqlite3.connect(catalogue_db)
+    prepare_database(setup)
+    setup.close()
+    assert tools.name_match(conn) == tools.SEARCH_INDEX_MATCH
+
+    statements = []
+    conn.set_trace_callback(statements.append)
+    for _ in range(3):
+        tools.fetch_product_page(conn, "KitKat", 5, None)
+    assert not any("sqlite_master" in statement for statement in statements)
+    conn.close()
+
+
+@pytest.mark.parametrize("include_facets", [True, False])
+def test_product_lookup_skips_null_categories(catalogue_db, monkeypatch, include_facets):
+    import threading
+
+    monkeypatch.setattr(tools, "DB_PATH", catalogue_db)
+    monkeypatch.setattr(tools, "_local", threading.local())
+    monkeypatch.setattr(tools, "search_cache", tools.LRUCache(tools.SEARCH_CACHE_SIZE))
+
+    # SKU 100 is the exact match, ranks first and has no product category
+    results = tools.ProductLookupTool().invoke({"name": "KitKat", "include_facets": include_facets})
+
+    assert results.all_products[0].sku == 100
+    assert results.all_products[0].product_category is None
+    assert None not in results.by_product_category
+    assert None not in results.unique_product_categories
+    assert results.by_buyer_category["Adult Lunchbox Bisc"][0].sku == 100
+    if include_facets:
+        assert results.total_results == 26
+        assert results.product_category_counts == {"Kit Kat": 20, "Prem Choc": 5}
@@ -0,0 +1,128 @@
+import time
+import threading
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.runnables import Runnable
+
+import tools
+import dialogue_manager
+from chain_registry import ChainRegistry
+from model_router import ModelRouter, STRONG, FAST
+
+LLM_DELAY = 0.2
+
+
+class DelayedChatModel(Runnable):
+    """ Stub chat model: every call sleeps, then answers with a parseable identification """
+
+    def invoke(self, input, config=None, **kwargs):
+        time.sleep(LLM_DELAY)
+        return AIMessage(content='{"mentioned": true, "product_name": "Chunky KitKat"}')
+
+
+@pytest.fixture
+def stubbed_workflow(catalogue_db, monkeypatch):
+    model = DelayedChatModel()
+    router = ModelRouter(models={STRONG: model, FAST: model}, node_tiers=dialogue_manager.NODE_TIERS)
+    monkeypatch.setattr(dialogue_manager, "chain_registry", ChainRegistry(router))
+    monkeypatch.setattr(tools, "DB_PATH", catalogue_db)
+    monkeypatch.setattr(tools, "_local", threading.local())
+    monkeypatch.setattr(tools, "search_cache", tools.LRUCache(tools.SEARCH_CACHE_SIZE))
+    monkeypatch.setattr(tools, "facet_cache", tools.LRUCache(tools.SEARCH_CACHE_SIZE))
+    return dialogue_manager.create_workflow()
+
+
+def user_turn():
+    state = dialogue_manager.get_initial_state()
+    state["conversation_history"].append(HumanMessage(content="I want to build audiences for KitKat"))
+    return state
+
+
+def run_sequentially(state):
+    """ The pre-branching graph: every node strictly one after another """
+    for node in (
+        dialogue_manager.greet,
+        dialogue_manager.identify_product,
+        dialogue_manager.confirm_product,
+        dialogue_manager.search_products,
+        dialogue_manager.expand_categories,
+        dialogue_manager.summarise_products,
+        dialogue_manager.present_product_details,
+        dialogue_manager.format_product_table,
+    ):
+        state = {**state, **node(state)}
+    return state
+
+
+def timed_run(fn, state):
+    start = time.perf_counter()
+    result = fn(state)
+    return result, time.perf_counter() - start
+
+
+def test_confirmation_overlaps_lookup_and_summary(stubbed_workflow):
+    # One untimed turn each, so one-off import and setup costs are not measured
+    run_sequentially(user_turn())
+    stubbed_workflow.invoke(user_turn())
+
+    sequential, before = timed_run(run_sequentially, user_turn())
+    branched, after = timed_run(stubbed_workflow.invoke, user_turn())
+
+    print(f"\ncritical path per turn with {LLM_DELAY:.1f}s stub LLM calls: before {before:.3f}s, after {after:.3f}s")
+
+    # greet, extract, confirm, summary and table all cost one LLM call when
+    # run in sequence; confirm now overlaps the lookup branch, removing one
+    assert before >= 5 * LLM_DELAY
+    assert after < before - 0.75 * LLM_DELAY
+    assert after < 4.75 * LLM_DELAY
+
+    # The join keeps the conversation in order
+    contents = [m.content for m in branched["conversation_history"]]
+    assert contents == [m.content for m in sequential["conversation_history"]]
+    assert len(contents) == 5 and isinstance(branched["conversation_history"][0], HumanMessage)
+    assert branched["product_search_results"].total_results == 5
+    assert branched["product_search_results"].buyer_category_counts == {"Single Confectionery": 5}
+
+
+def test_product_not_found_ends_turn_after_apology(stubbed_workflow, monkeypatch):
+    class NoProductModel(DelayedChatModel):
+        def invoke(self, input, config=None, **kwargs):
+            time.sleep(0.01)
+            return AIMessage(content='{"mentioned": true, "product_name": "Gobstopper"}')
+
+    model = NoProductModel()
+    router = ModelRouter(models={STRONG: model, FAST: model}, node_tiers=dialogue_manager.NODE_TIERS)
+    monkeypatch.setattr(dialogue_manager, "chain_registry", ChainRegistry(router))
+
+    result = stubbed_workflow.invoke(user_turn())
+
+    assert result["product_search_results"] is None
+    assert result["current_node"] == dialogue_manager.END
+    # user message, greeting, confirmation, not-found reply; no table
+    assert len(result["conversation_history"]) == 4
+
+
+def test_lookup_subgraph_receives_the_turn_config(stubbed_workflow, monkeypatch):
+    configs = []
+    create_lookup_workflow = dialogue_manager.create_lookup_workflow
+
+    class RecordingSubgraph:
+        def __init__(self):
+            self.graph = create_lookup_workflow()
+
+        def invoke(self, state, config=None):
+            configs.append(config)
+            return self.graph.invoke(state, config)
+
+    monkeypatch.setattr(dialogue_manager, "create_lookup_workflow", RecordingSubgraph)
+    workflow = dialogue_manager.create_workflow()
+
+    workflow.invoke(user_turn(), {"recursion_limit": 42, "tags": ["turn"], "metadata": {"chat": "c1"}})
+
+    # Callbacks, tags and the recursion limit of the turn reach the subgraph
+    config, = configs
+    assert config["recursion_limit"] == 42
+    assert "turn" in config["tags"]
+    assert config["metadata"]["chat"] == "c1"
+    assert config.get("callbacks") is not None
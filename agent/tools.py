@@ -1,19 +1,117 @@
+import os
 import sqlite3
+import json
+import base64
+import threading
 
 from langchain.tools import BaseTool
-from typing import Type, ClassVar
+from typing import Type, ClassVar, Dict, Iterator, List, Literal, Optional, Tuple
 from pydantic import BaseModel, Field
 from schema import ProductDetails, ProductSearchResults
+from catalogue_snapshot import get_catalogue_snapshot
+from singleflight import create_single_flight
 
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 
-DB_PATH = "/home/azureuser/projects/whizzbang_audience/db/db.db"
+DB_PATH = os.getenv("CATALOGUE_DB_PATH", "/home/azureuser/projects/whizzbang_audience/db/db.db")
+
+# Trigram index over skuName maintained by ingest_catalogue.py
+SEARCH_INDEX = "DIM_ITEMS_SEARCH"
+
+# Product names searched, one per line, used to pick queries to warm up.
+# Rotated to QUERY_LOG_PATH.1 when it passes QUERY_LOG_MAX_BYTES.
+QUERY_LOG_PATH = os.getenv("QUERY_LOG_PATH")
+QUERY_LOG_MAX_BYTES = int(os.getenv("QUERY_LOG_MAX_BYTES", str(1024 * 1024)))
+
+SEARCH_CACHE_SIZE = 256
+
+_local = threading.local()
+_query_log_lock = threading.Lock()
+
+
+class CatalogueConnection(sqlite3.Connection):
+    """ Connection that remembers which name filter its catalogue supports """
+    name_match: Optional[str] = None
+
+
+def get_connection() -> sqlite3.Connection:
+    """ This thread's pooled connection to the catalogue database """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = sqlite3.connect(DB_PATH, factory=CatalogueConnection)
+    return conn
+
+
+def close_connection():
+    """ Close this thread's pooled connection, if it has one """
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        _local.conn = None
+        conn.close()
+
+
+class LRUCache:
+    """ Small thread-safe LRU for lookup results """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+
+# Keyed on the catalogue version, so an ingestion invalidates every entry
+search_cache = LRUCache(SEARCH_CACHE_SIZE)
+facet_cache = LRUCache(SEARCH_CACHE_SIZE)
+
+
+def log_query(name: str):
+    if not QUERY_LOG_PATH:
+        return
+    with _query_log_lock:
+        with open(QUERY_LOG_PATH, "a", encoding="utf-8") as f:
+            f.write(name.strip().replace("\n", " ") + "\n")
+            size = f.tell()
+        if size >= QUERY_LOG_MAX_BYTES:
+            # Keep one previous file, so warm-up reads at most twice the cap
+            os.replace(QUERY_LOG_PATH, f"{QUERY_LOG_PATH}.1")
+
+# Identical searches in flight at the same time share one database query
+product_search_flight = create_single_flight(
+    "product_search",
+    serialize=lambda results: results.model_dump_json(),
+    deserialize=ProductSearchResults.model_validate_json
+)
 
 class SKULookupInput(BaseModel):
     sku: str = Field(..., description="The product SKU to lookup")
 
+DEFAULT_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 100
+
+class CategoryLookupInput(BaseModel):
+    category: str = Field(..., description="The category name to lookup")
+    level: Literal["buyer", "product"] = Field("product", description="Buyer category (L4) or product category (L5)")
+    limit: int = Field(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Maximum number of products to return")
+
 class ProductLookupInput(BaseModel):
-    sku: str = Field(..., description="The product name to lookup")
+    name: str = Field(..., description="The product name to lookup")
+    limit: int = Field(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Maximum number of products to return")
+    cursor: Optional[str] = Field(None, description="Cursor returned by a previous search, to fetch the next page")
+    include_facets: bool = Field(True, description="Whether to count matches per category across all pages")
 
 class SKULookupTool(BaseTool):
     name: ClassVar[str] = "product_database_lookup"
@@ -22,11 +120,16 @@ class SKULookupTool(BaseTool):
 
     def _run(self, sku: str) -> ProductDetails:
         """ Query the database for product details """
-        db_path = DB_PATH
+        # Answer from the shared catalogue snapshot when one is mapped
+        snapshot = get_catalogue_snapshot()
+        if snapshot is not None:
+            product = snapshot.get_sku(sku)
+            if product is not None:
+                return product
 
         try:
             print(f"Querying database for SKU: {sku}")
-            conn = sqlite3.connect(db_path)
+            conn = get_connection()
             cursor = conn.cursor()
 
             query = """
@@ -36,7 +139,6 @@ class SKULookupTool(BaseTool):
             """
             cursor.execute(query, (sku,))
             result = cursor.fetchone()
-            conn.close()
 
             print(result)
 
@@ -54,96 +156,287 @@ class SKULookupTool(BaseTool):
             raise ValueError(f"DB Error: {e}")
         
 
+# Name matching shared by the page and facet queries. Every row that matches
+# the prefix or suffix patterns also matches the substring one, so the ranking
+# below is the only place the distinction matters.
+NAME_MATCH = """
+    skuName LIKE :name || '%' OR
+    skuName LIKE '%' || :name OR
+    skuName LIKE '%' || :name || '%'
+"""
+
+# Keyset pagination: rows are ordered by (match_rank DESC, skuId ASC) and the
+# cursor carries the last (match_rank, skuId) seen, so a page can be resumed
+# without OFFSET. match_rank is computed per row, so every execution still
+# ranks and sorts the whole match set; callers that need many pages should
+# run it once and fetchmany() through it, as iter_product_pages does.
+PAGE_QUERY = """
+SELECT skuId, skuName, catLevel4Name, catLevel5Name, match_rank
+FROM (
+    SELECT
+        skuId,
+        skuName,
+        catLevel4Name,
+        catLevel5Name,
+        CASE
+            WHEN skuName = :name THEN 10
+            WHEN skuName LIKE :name || '%' THEN 8
+            WHEN skuName LIKE '%' || :name || '%' THEN 6
+            ELSE 1
+        END AS match_rank
+    FROM DIM_ITEMS
+    WHERE {match}
+)
+WHERE
+    :after_rank IS NULL OR
+    match_rank < :after_rank OR
+    (match_rank = :after_rank AND skuId > :after_sku)
+ORDER BY match_rank DESC, skuId ASC
+LIMIT :limit;
+"""
+
+# Same matches as NAME_MATCH, but resolved through the trigram index instead
+# of scanning every skuName
+SEARCH_INDEX_MATCH = f"""
+    skuId IN (
+        SELECT rowid FROM {SEARCH_INDEX}
+        WHERE skuName LIKE '%' || :name || '%'
+    )
+"""
+
+FACET_QUERY = """
+SELECT {column}, COUNT(*)
+FROM DIM_ITEMS
+WHERE {match}
+GROUP BY {column}
+ORDER BY COUNT(*) DESC;
+"""
+
+
+def name_match(conn: sqlite3.Connection) -> str:
+    """ Pick the name filter: the trigram index when the catalogue has one """
+    # Pooled connections remember the index once found. Without it the LIKE
+    # scan dominates anyway, and checking again picks up an index that
+    # ingestion creates later.
+    match = getattr(conn, "name_match", None)
+    if match is None:
+        has_index = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (SEARCH_INDEX,)
+        ).fetchone()
+        if not has_index:
+            return NAME_MATCH
+        match = SEARCH_INDEX_MATCH
+        if isinstance(conn, CatalogueConnection):
+            conn.name_match = match
+    return match
+
+
+def catalogue_version(conn: sqlite3.Connection) -> int:
+    """ Version bumped by every ingestion that changes DIM_ITEMS, 0 if never ingested """
+    try:
+        row = conn.execute("SELECT value FROM CATALOGUE_META WHERE key = 'version'").fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return int(row[0]) if row else 0
+
+
+def encode_cursor(match_rank: int, sku) -> str:
+    """ Encode the last row of a page as an opaque cursor """
+    raw = json.dumps([match_rank, sku]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Tuple[int, object]:
+    """ Decode a cursor produced by encode_cursor """
+    try:
+        match_rank, sku = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+    # Only scalars can be bound as query parameters
+    if type(match_rank) is not int or type(sku) not in (int, str):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return match_rank, sku
+
+
+def _to_products(rows) -> List[ProductDetails]:
+    return [
+        ProductDetails(
+            sku=row[0],
+            product_name=row[1],
+            buyer_category=row[2],
+            product_category=row[3]
+        )
+        for row in rows
+    ]
+
+
+def fetch_product_page(
+    conn: sqlite3.Connection,
+    name: str,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+) -> Tuple[list, Optional[str]]:
+    """ Fetch one page of matching products and the cursor for the next page """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    after_rank, after_sku = decode_cursor(cursor) if cursor else (None, None)
+
+    # Ask for one extra row so we know whether another page exists
+    rows = conn.execute(PAGE_QUERY.format(match=name_match(conn)), {
+        "name": name,
+        "after_rank": after_rank,
+        "after_sku": after_sku,
+        "limit": limit + 1,
+    }).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][4], rows[-1][0])
+
+    return _to_products(rows), next_cursor
+
+
+def fetch_category_facets(conn: sqlite3.Connection, name: str) -> Tuple[int, Dict[str, int], Dict[str, int]]:
+    """ Count every match per buyer (L4) and product (L5) category in the database """
+    facets = []
+    total = 0
+    for column in ("catLevel4Name", "catLevel5Name"):
+        rows = conn.execute(
+            FACET_QUERY.format(column=column, match=name_match(conn)),
+            {"name": name}
+        ).fetchall()
+        total = sum(count for _, count in rows)
+        facets.append({category: count for category, count in rows if category is not None})
+
+    return total, facets[0], facets[1]
+
+
+def lookup_category_facets(name: str) -> Dict:
+    """ Count matches for a product name per buyer and product category """
+    try:
+        conn = get_connection()
+        key = (catalogue_version(conn), name)
+        facets = facet_cache.get(key)
+        if facets is None:
+            total_results, buyer_category_counts, product_category_counts = fetch_category_facets(conn, name)
+            facets = {
+                "total_results": total_results,
+                "buyer_category_counts": buyer_category_counts,
+                "product_category_counts": product_category_counts,
+            }
+            facet_cache.put(key, facets)
+    except sqlite3.Error as e:
+        raise ValueError(f"DB Error: {e}")
+
+    return facets
+
+
+def iter_product_pages(
+    name: str,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+) -> Iterator[Tuple[list, Optional[str]]]:
+    """ Yield successive pages of matching products until the results run out """
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    after_rank, after_sku = decode_cursor(cursor) if cursor else (None, None)
+
+    # The caller may resume iteration from another thread (e.g. a streaming response)
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    try:
+        # Rank and sort the match set once, then stream it page by page
+        rows_cursor = conn.execute(PAGE_QUERY.format(match=name_match(conn)), {
+            "name": name,
+            "after_rank": after_rank,
+            "after_sku": after_sku,
+            "limit": -1,
+        })
+
+        rows = rows_cursor.fetchmany(page_size)
+        while rows:
+            # Read ahead one page so the last page carries no cursor
+            following = rows_cursor.fetchmany(page_size)
+            next_cursor = encode_cursor(rows[-1][4], rows[-1][0]) if following else None
+            yield _to_products(rows), next_cursor
+            rows = following
+    finally:
+        conn.close()
+
+
 class ProductLookupTool(BaseTool):
     name: ClassVar[str] = "product_database_lookup"
     description: ClassVar[str] = "Use this tool to look up a product in the database by its name"
     args_schema: ClassVar[Type[BaseModel]] = ProductLookupInput
 
-    def _run(self, name: str) -> ProductSearchResults:
-        """ Query the database for product details and group by categories """
-        db_path = DB_PATH
+    def _run(
+        self,
+        name: str,
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: Optional[str] = None,
+        include_facets: bool = True,
+    ) -> ProductSearchResults:
+        """ Search for products, sharing one query between identical concurrent searches """
+        search = (name, limit, cursor, include_facets)
+        try:
+            key = (catalogue_version(get_connection()), *search)
+        except sqlite3.Error as e:
+            raise ValueError(f"DB Error: {e}")
+
+        results = search_cache.get(key)
+        if results is None:
+            results = product_search_flight.do(
+                search,
+                lambda: self._search(name, limit, cursor, include_facets)
+            )
+            search_cache.put(key, results)
+        return results
 
+    def _search(self, name: str, limit: int, cursor: Optional[str], include_facets: bool) -> ProductSearchResults:
+        """ Query the database for a page of product details and group by categories """
         try:
-            print(f"Querying database for name: {name}")
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
+            print(f"Querying database for name: {name} (limit={limit}, cursor={cursor})")
+            conn = get_connection()
 
-            query = """
-            SELECT 
-                skuId,
-                skuName,
-                catLevel4Name,
-                catLevel5Name
-            FROM 
-                DIM_ITEMS
-            WHERE 
-                skuName LIKE ? || '%' OR
-                skuName LIKE '%' || ? OR
-                skuName LIKE '%' || ? || '%'
-            ORDER BY 
-                CASE
-                    WHEN skuName = ? THEN 10
-                    WHEN skuName LIKE ? || '%' THEN 8
-                    WHEN skuName LIKE '%' || ? || '%' THEN 6
-                    ELSE 1
-                END DESC
-            LIMIT 10;
-            """
-            
-            params = (name, name, name, name, name, name)
-            cursor.execute(query, params)
-            
-            results = cursor.fetchall()
-            conn.close()
+            all_products, next_cursor = fetch_product_page(conn, name, limit, cursor)
+            if include_facets:
+                total_results, buyer_category_counts, product_category_counts = fetch_category_facets(conn, name)
+            else:
+                # Without the facet queries, describe this page only
+                total_results = len(all_products)
+                buyer_category_counts = {}
+                product_category_counts = {}
 
-            print(f"Found {len(results)} results")
+            print(f"Found {len(all_products)} results on this page, {total_results} in total")
             
-            if results:
-                # Build a dictionary to group products by categories
+            if all_products:
+                # Group this page of products by categories; facet counts
+                # over the whole result set come from the database
                 by_buyer_category = defaultdict(list)
                 by_product_category = defaultdict(list)
                 
-                # Also track unique categories
-                unique_buyer_categories = set()
-                unique_product_categories = set()
-                
-                # Process all results
-                all_products = []
-                for row in results:
-                    sku_id = row[0]
-                    product_name = row[1]
-                    buyer_category = row[2]
-                    product_category = row[3]
-                    
-                    # Create product object
-                    product = ProductDetails(
-                        sku=sku_id,
-                        product_name=product_name,
-                        buyer_category=buyer_category,
-                        product_category=product_category
-                    )
-                    
-                    # Add to our collections
-                    all_products.append(product)
-                    by_buyer_category[buyer_category].append(product)
-                    by_product_category[product_category].append(product)
-                    
-                    # Track unique categories
-                    unique_buyer_categories.add(buyer_category)
-                    unique_product_categories.add(product_category)
+                for product in all_products:
+                    # Uncategorised products stay in all_products but, as in
+                    # fetch_category_facets, are left out of the grouping
+                    if product.buyer_category is not None:
+                        by_buyer_category[product.buyer_category].append(product)
+                    if product.product_category is not None:
+                        by_product_category[product.product_category].append(product)
                 
                 # Build the response object
                 response = ProductSearchResults(
                     query=name,
-                    total_results=len(results),
-                    unique_buyer_categories=list(unique_buyer_categories),
-                    unique_product_categories=list(unique_product_categories),
+                    total_results=total_results,
+                    unique_buyer_categories=list(buyer_category_counts or by_buyer_category),
+                    unique_product_categories=list(product_category_counts or by_product_category),
+                    buyer_category_counts=buyer_category_counts,
+                    product_category_counts=product_category_counts,
                     by_buyer_category=dict(by_buyer_category),
                     by_product_category=dict(by_product_category),
-                    all_products=all_products
+                    all_products=all_products,
+                    next_cursor=next_cursor
                 )
                 
-                print(f"\nFound products in {len(unique_buyer_categories)} buyer categories and {len(unique_product_categories)} product categories\n")
+                print(f"\nFound products in {len(response.unique_buyer_categories)} buyer categories and {len(response.unique_product_categories)} product categories\n")
                 
                 return response
             else:
@@ -151,10 +444,34 @@ class ProductLookupTool(BaseTool):
             
         except sqlite3.Error as e:
             raise ValueError(f"DB Error: {e}")
-        
 
-            
 
+class CategoryLookupTool(BaseTool):
+    name: ClassVar[str] = "category_database_lookup"
+    description: ClassVar[str] = "Use this tool to list the products in a buyer (L4) or product (L5) category"
+    args_schema: ClassVar[Type[BaseModel]] = CategoryLookupInput
 
+    def _run(self, category: str, level: str = "product", limit: int = DEFAULT_PAGE_SIZE) -> List[ProductDetails]:
+        """ List products in a category, from the catalogue snapshot when available """
+        snapshot = get_catalogue_snapshot()
+        if snapshot is not None:
+            if level == "buyer":
+                return snapshot.by_buyer_category(category, limit)
+            return snapshot.by_product_category(category, limit)
 
+        column = "catLevel4Name" if level == "buyer" else "catLevel5Name"
 
+        try:
+            print(f"Querying database for {level} category: {category}")
+            rows = get_connection().execute(f"""
+            SELECT skuId, skuName, catLevel4Name, catLevel5Name
+            FROM DIM_ITEMS
+            WHERE {column} = ?
+            ORDER BY skuId
+            LIMIT ?
+            """, (category, limit)).fetchall()
+
+            return _to_products(rows)
+
+        except sqlite3.Error as e:
+            raise ValueError(f"DB Error: {e}")